@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""
+Audit trail ของการเปลี่ยนค่าความยินยอม (data_cdp) และสิทธิ์ collaborator
+
+record() ถูกเรียกจาก hook ซึ่งทำงานก่อนที่ action จะ commit รายการจึงถูกพักไว้
+ใน transaction ของ model.Session (ดู transaction.py) และย้ายเข้า buffer ใน
+หน่วยความจำเมื่อ commit เท่านั้น การบันทึกที่ rollback จึงไม่มี audit
+
+ข้อมูลใน buffer ถูกเขียนลงตาราง ``cdp_audit`` ด้วย INSERT หลายแถวในคำสั่งเดียว
+ทุก ``ckanext.cdp.audit_flush_interval`` วินาที (ค่าเริ่มต้น 5) หรือทันทีเมื่อ
+buffer มีครบ ``ckanext.cdp.audit_buffer_size`` รายการ (ค่าเริ่มต้น 500) โดย
+  - background thread ที่เริ่มเมื่อมีรายการแรกใน process นั้น (ไม่ใช่ตอนโหลด
+    plugin ซึ่งอาจเป็น master process ก่อน fork)
+  - flush_if_due() ตอนจบแต่ละ request (ดู views.py) สำหรับ server ที่ไม่ให้
+    thread ของ app ทำงาน เช่น uWSGI ที่ไม่ได้เปิด enable-threads
+  - ตอน process จบการทำงาน
+
+การเขียนใช้ connection แยกจาก model.Session จึงไม่ปนกับ transaction ของ action
+"""
+import atexit
+import collections
+import datetime
+import logging
+import os
+import threading
+import time
+
+import ckan.plugins.toolkit as toolkit
+from ckan.model import meta
+
+from ckanext.cdp import transaction
+from ckanext.cdp.model import cdp_audit_table
+
+log = logging.getLogger(__name__)
+
+# ชื่อของรายการที่พักไว้ใน transaction
+PENDING_NAME = 'cdp_audit'
+
+_buffer = collections.deque()
+_flush_lock = threading.Lock()
+_start_lock = threading.Lock()
+_wakeup = threading.Event()
+_thread = None
+# process ที่ thread และ buffer เป็นของ (เปลี่ยนเมื่อ fork)
+_pid = None
+_last_flush = time.time()
+_buffer_size = 500
+_interval = 5.0
+# ถ้าเขียนฐานข้อมูลไม่ได้นานๆ จะเก็บไว้ไม่เกินจำนวนนี้ แล้วทิ้งรายการเก่าสุด
+_max_backlog = 50000
+
+
+def record(package_id, actor=None, field=None, old_value=None,
+           new_value=None, collaborator_user_id=None, capacity=None,
+           result=None):
+    """
+    เพิ่มรายการ audit ที่จะเข้า buffer เมื่อ transaction ปัจจุบัน commit
+    (ไม่เขียนฐานข้อมูลทันที)
+    """
+    transaction.register(PENDING_NAME, _enqueue)
+    transaction.stage(PENDING_NAME, {
+        'created': datetime.datetime.utcnow(),
+        'package_id': package_id,
+        'actor': actor,
+        'field': field,
+        'old_value': old_value,
+        'new_value': new_value,
+        'collaborator_user_id': collaborator_user_id,
+        'capacity': capacity,
+        'result': result,
+    })
+
+
+def _enqueue(rows):
+    """
+    ย้ายรายการของ transaction ที่ commit แล้วเข้า buffer
+    """
+    _ensure_flusher()
+    _buffer.extend(rows)
+    dropped = 0
+    while len(_buffer) > _max_backlog:
+        _buffer.popleft()
+        dropped += 1
+    if dropped:
+        log.warning('CDP audit buffer full, dropped the %d oldest records',
+                    dropped)
+    if len(_buffer) >= _buffer_size:
+        _wakeup.set()
+
+
+def flush():
+    """
+    เขียนทุกรายการใน buffer ลงฐานข้อมูลด้วย INSERT หลายแถว คืนจำนวนที่เขียน
+    """
+    with _flush_lock:
+        return _flush_locked()
+
+
+def _flush_locked():
+    global _last_flush
+    _last_flush = time.time()
+    rows = []
+    while _buffer:
+        rows.append(_buffer.popleft())
+    if not rows:
+        return 0
+    try:
+        meta.engine.execute(cdp_audit_table.insert().values(rows))
+    except Exception:
+        # ใส่กลับเข้า buffer เพื่อลองใหม่รอบถัดไป
+        _buffer.extendleft(reversed(rows))
+        raise
+    return len(rows)
+
+
+def flush_if_due():
+    """
+    เขียน buffer ถ้าครบรอบเวลาหรือ buffer เต็มแล้ว (เรียกตอนจบ request)
+    ถ้า thread อื่นกำลังเขียนอยู่จะไม่รอ คืนจำนวนที่เขียน
+    """
+    if not _buffer or (len(_buffer) < _buffer_size and
+                       time.time() - _last_flush < _interval):
+        return 0
+    if not _flush_lock.acquire(False):
+        return 0
+    try:
+        return _flush_locked()
+    finally:
+        _flush_lock.release()
+
+
+def _run():
+    while True:
+        _wakeup.wait(_interval)
+        _wakeup.clear()
+        try:
+            flush()
+        except Exception:
+            log.exception('Could not write CDP audit records')
+
+
+def _ensure_flusher():
+    """
+    เริ่ม background thread ของ process นี้ ถ้ายังไม่มี (เช่นเพิ่ง fork มา)
+    """
+    global _thread, _pid, _flush_lock
+    if _pid == os.getpid():
+        return
+    with _start_lock:
+        pid = os.getpid()
+        if _pid == pid:
+            return
+        if _pid is not None:
+            # process ลูกหลัง fork: thread ของ process แม่ไม่ได้ตามมาด้วย
+            # และรายการที่ copy มาเป็นของ process แม่
+            _buffer.clear()
+            _flush_lock = threading.Lock()
+        _pid = pid
+        _thread = threading.Thread(target=_run, name='cdp-audit-flush')
+        _thread.daemon = True
+        _thread.start()
+        atexit.register(_flush_at_exit, pid)
+
+
+def configure(config):
+    """
+    อ่าน config (เรียกจาก update_config) thread จะเริ่มเมื่อมีรายการแรก
+    """
+    global _buffer_size, _interval, _max_backlog
+    _buffer_size = toolkit.asint(
+        config.get('ckanext.cdp.audit_buffer_size', 500))
+    _max_backlog = max(_buffer_size * 100, _max_backlog)
+    _interval = float(config.get('ckanext.cdp.audit_flush_interval', 5))
+
+
+def _flush_at_exit(pid):
+    if pid != os.getpid():
+        return
+    try:
+        flush()
+    except Exception:
+        log.exception('Could not write CDP audit records at exit')
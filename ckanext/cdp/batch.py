@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+Batch mode สำหรับ harvest และการ import จำนวนมาก
+
+ภายใน batch hook ของ CdpPlugin จะไม่เขียน package_member ทีละ dataset
+แต่จะจด id ของ dataset ไว้ เมื่อปิด batch จึง reconcile ทั้งหมดด้วยคำสั่ง
+set-based ชุดเดียว (collaborator.reconcile_packages) สถานะสุดท้ายเหมือนกับ
+การ reconcile ทีละ dataset เพราะอ่านค่าล่าสุดจากฐานข้อมูลตามกฎใน rules.py
+
+ใช้ได้สองแบบ::
+
+    from ckanext.cdp.batch import cdp_batch
+
+    with cdp_batch():
+        for record in records:
+            toolkit.get_action('package_create')(context, record)
+
+หรือส่ง batch ไปใน context ของ action (เช่นจาก harvester)::
+
+    batch = CdpBatch()
+    context['cdp_batch'] = batch
+    ...
+    batch.flush()
+"""
+import logging
+import threading
+
+from ckanext.cdp import collaborator, rules
+
+log = logging.getLogger(__name__)
+
+_local = threading.local()
+
+
+class CdpBatch(object):
+    """
+    เก็บ id ของ dataset ที่ถูกสร้าง/แก้ไขระหว่าง batch
+    """
+
+    def __init__(self):
+        self.package_ids = set()
+
+    def add(self, package_id):
+        self.package_ids.add(package_id)
+
+    def flush(self):
+        """
+        reconcile dataset ที่จดไว้ทั้งหมดแล้วเริ่มนับใหม่ คืนจำนวนแถวที่เปลี่ยน
+        """
+        if not self.package_ids:
+            return {'added': 0, 'updated': 0, 'removed': 0}
+        package_ids, self.package_ids = self.package_ids, set()
+        ruleset = rules.get_ruleset()
+        counts = {'added': 0, 'updated': 0, 'removed': 0}
+        for name, user_id in ruleset.user_ids().items():
+            user_counts = collaborator.reconcile_packages(
+                user_id, ruleset.predicates(name), package_ids)
+            for key, count in user_counts.items():
+                counts[key] += count
+        log.info('CDP batch reconciled %d datasets: %r',
+                 len(package_ids), counts)
+        return counts
+
+    def __enter__(self):
+        _stack().append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _stack().remove(self)
+        # dataset ที่สร้างไปแล้วถูก commit แล้ว จึง reconcile แม้ batch จบด้วย error
+        self.flush()
+        return False
+
+
+def cdp_batch():
+    """
+    context manager ที่เปิด batch สำหรับ thread ปัจจุบัน
+    """
+    return CdpBatch()
+
+
+def _stack():
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+
+def current_batch(context=None):
+    """
+    คืน batch ที่ใช้อยู่: จาก context['cdp_batch'] ก่อน แล้วจึงเป็น batch
+    ที่เปิดด้วย ``with cdp_batch()`` ล่าสุดใน thread นี้ หรือ None
+    """
+    batch = (context or {}).get('cdp_batch')
+    if isinstance(batch, CdpBatch):
+        return batch
+    stack = _stack()
+    return stack[-1] if stack else None
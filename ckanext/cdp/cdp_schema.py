@@ -1,80 +1,343 @@
 # -*- coding: utf-8 -*-
+import hashlib
+import io
 import json
+import logging
+import os
+import tempfile
+
 import pkg_resources
 import ckan.plugins.toolkit as toolkit
-import codecs
+
+log = logging.getLogger(__name__)
+
+# schema ที่ commit มากับ extension ใช้เป็นค่าสำรองเมื่อไม่ได้ติดตั้ง thai_gdc
+BUNDLED_SCHEMA = 'ckanext.cdp:ckan_dataset_cdp.json'
+
+# เพิ่มค่านี้เมื่อเปลี่ยนวิธี merge เพื่อให้ cache เดิมใช้ไม่ได้
+MERGE_VERSION = 4
+
+CUSTOM_FIELD = {
+    "field_name": "data_cdp",
+    "label": {
+        "en": "Send data to CDP",
+        "th": "ยินยอมให้ส่งชุดข้อมูลไปใช้ในโครงการ CDP หรือไม่"
+    },
+    "choices": [
+        {"value": "yes", "label": "ใช่"},
+        {"value": "no", "label": "ไม่ใช่"}
+    ],
+    "form_snippet": "select.html",
+    "display_snippet": "select.html",
+    "form_data_type": [
+        "ข้อมูลระเบียน",
+        "ข้อมูลสถิติ",
+        "ข้อมูลภูมิสารสนเทศเชิงพื้นที่",
+        "ข้อมูลหลากหลายประเภท",
+        "ข้อมูลประเภทอื่นๆ"
+    ],
+    "validators":  "convert_to_extras ignore_missing"
+}
+
+# validator ที่เพิ่มให้ฟิลด์กรอบพื้นที่ของ thai_gdc (ดู validators.py และ spatial.py)
+# ฟิลด์ทิศเหนือ/ใต้ชื่อว่า longitude แต่เก็บค่า latitude
+FIELD_VALIDATORS = {
+    "west_bound_longitude": "ignore_missing cdp_bbox_longitude",
+    "east_bound_longitude": "ignore_missing cdp_bbox_longitude",
+    "north_bound_longitude": "ignore_missing cdp_bbox_latitude",
+    "south_bound_longitude": "ignore_missing cdp_bbox_latitude",
+}
+
+# validator ตรวจ choice ของ scheming -> prefix ของ validator ที่ compile ไว้
+# ตอนโหลด schema (ดู choice_validators) ซึ่งให้ผลเหมือนกันแต่ไม่ต้องสร้าง set
+# ของ choices ใหม่ทุกครั้งที่ validate แทนที่เฉพาะฟิลด์ที่ใช้ validator
+# เหล่านี้อยู่แล้ว ฟิลด์อื่นไม่ถูกเปลี่ยน
+CHOICE_VALIDATOR_PREFIX = 'cdp_choice_'
+MULTIPLE_CHOICE_VALIDATOR_PREFIX = 'cdp_multiple_choice_'
+SCHEMING_CHOICE_VALIDATORS = {
+    'scheming_choices': CHOICE_VALIDATOR_PREFIX,
+    'scheming_multiple_choice': MULTIPLE_CHOICE_VALIDATOR_PREFIX,
+}
+
+
+def _original_schema_path():
+    return pkg_resources.resource_filename('ckanext.thai_gdc', 'ckan_dataset.json')
+
 
 def load_original_schema():
     """
     โหลด schema ของ dataset จาก extension thai_gdc โดยอ่านไฟล์ ckan_dataset.json จาก package ckanext.thai_gdc
     """
-    schema_path = pkg_resources.resource_filename('ckanext.thai_gdc', 'ckan_dataset.json')
-    with codecs.open(schema_path, encoding='utf-8') as f:
+    with io.open(_original_schema_path(), encoding='utf-8') as f:
         original_schema = json.load(f)
     return original_schema
 
 def merge_custom_field(schema):
     """
     รวมฟิลด์ custom 'data_cdp' เข้ากับ schema เดิม โดยเพิ่มฟิลด์นี้เข้าไปใน 'dataset_fields' ถ้ายังไม่มีอยู่
+    และเพิ่ม validator ตาม FIELD_VALIDATORS ให้ฟิลด์ที่ยังไม่ได้กำหนด validators
+    รวมทั้งแทน validator ตรวจ choice ของ scheming ด้วยตัวที่ compile ไว้
     """
-    custom_field = {
-        "field_name": "data_cdp",
-        "label": {
-            "en": "Send data to CDP",
-            "th": "ยินยอมให้ส่งชุดข้อมูลไปใช้ในโครงการ CDP หรือไม่"
-        },
-        "choices": [
-            {"value": "yes", "label": "ใช่"},
-            {"value": "no", "label": "ไม่ใช่"}
-        ],
-        "form_snippet": "select.html",
-        "display_snippet": "select.html",
-        "form_data_type": [
-            "ข้อมูลระเบียน", 
-            "ข้อมูลสถิติ", 
-            "ข้อมูลภูมิสารสนเทศเชิงพื้นที่", 
-            "ข้อมูลหลากหลายประเภท", 
-            "ข้อมูลประเภทอื่นๆ"
-        ],
-        "validators":  "convert_to_extras ignore_missing"
-    }
+    custom_field = json.loads(json.dumps(CUSTOM_FIELD))
     if 'dataset_fields' in schema:
         if not any(field.get("field_name") == "data_cdp" for field in schema['dataset_fields']):
             schema['dataset_fields'].append(custom_field)
     else:
         schema['dataset_fields'] = [custom_field]
+    fields = schema['dataset_fields'] + schema.get('resource_fields', [])
+    for field in fields:
+        name = field.get("field_name") or ''
+        validators = FIELD_VALIDATORS.get(name)
+        if field.get("choices") and "validators" in field:
+            field["validators"] = _with_choice_validator(field)
+        elif validators and "validators" not in field:
+            # ให้ฟิลด์กรอบพื้นที่ถูกแปลงเป็นตัวเลขตอนบันทึก
+            field["validators"] = validators
     return schema
 
+def _with_choice_validator(field):
+    """
+    คืน validators ของฟิลด์ที่มี choices โดยแทน scheming_choices และ
+    scheming_multiple_choice (ที่ตำแหน่งเดิม) ด้วยตัวที่ compile ไว้ของฟิลด์นั้น
+    validator อื่นไม่เปลี่ยน
+    """
+    return " ".join(
+        SCHEMING_CHOICE_VALIDATORS[token] + field["field_name"]
+        if token in SCHEMING_CHOICE_VALIDATORS else token
+        for token in field["validators"].split())
+
 def serialize_schema(data):
     """
     แปลงข้อมูล schema ให้อยู่ในรูปแบบที่สามารถ serialize เป็น JSON ได้ โดยมีการตรวจสอบ type ของข้อมูลและจัดการ conversion ให้เหมาะสม
     """
     if isinstance(data, dict):
-        return {serialize_schema(key): serialize_schema(value) for key, value in data.iteritems()}
-    elif isinstance(data, list):
+        return {serialize_schema(key): serialize_schema(value) for key, value in data.items()}
+    elif isinstance(data, (list, tuple)):
         return [serialize_schema(item) for item in data]
     elif callable(data):
         return data.__name__
-    elif isinstance(data, str):
+    elif isinstance(data, bytes):
         try:
             return data.decode('utf-8')
         except UnicodeDecodeError:
-            return data
+            return data.decode('latin-1')
     else:
         return data
 
+def schema_hash(original_bytes):
+    """
+    คำนวณ hash จากไฟล์ schema ต้นฉบับของ thai_gdc และนิยามฟิลด์ custom
+    ใช้เป็น key ของ cache ถ้าค่าใดค่าหนึ่งเปลี่ยน hash จะเปลี่ยนตาม
+    """
+    digest = hashlib.sha256()
+    digest.update(str(MERGE_VERSION).encode('ascii'))
+    digest.update(original_bytes)
+    digest.update(json.dumps(
+        [CUSTOM_FIELD, FIELD_VALIDATORS, SCHEMING_CHOICE_VALIDATORS],
+        sort_keys=True, ensure_ascii=False).encode('utf-8'))
+    return digest.hexdigest()
+
+def _cache_dir():
+    cache_dir = toolkit.config.get('ckanext.cdp.schema_cache_dir')
+    if not cache_dir:
+        cache_dir = os.path.join(
+            toolkit.config.get('cache_dir') or tempfile.gettempdir(),
+            'ckanext-cdp')
+    return cache_dir
+
+def _write_atomic(path, schema):
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with io.open(fd, 'w', encoding='utf-8') as f:
+            json.dump(schema, f, indent=4, ensure_ascii=False)
+        os.replace(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+def merged_schema_path(cache_dir=None):
+    """
+    คืน path ของไฟล์ schema ที่ merge แล้ว โดยใช้ไฟล์ใน cache ถ้า hash ตรงกัน
+    และ merge ใหม่ (แล้วเขียนลง cache) เฉพาะเมื่อ schema ต้นฉบับหรือฟิลด์ custom เปลี่ยน
+    """
+    with io.open(_original_schema_path(), 'rb') as f:
+        original_bytes = f.read()
+    path = os.path.join(
+        cache_dir or _cache_dir(),
+        'ckan_dataset_cdp-{}.json'.format(schema_hash(original_bytes)[:16]))
+    if os.path.exists(path):
+        return path
+
+    log.info('Merging CDP dataset schema into %s', path)
+    schema = merge_custom_field(json.loads(original_bytes.decode('utf-8')))
+    _write_atomic(path, serialize_schema(schema))
+    return path
+
+
+_current_path = None
+
+
+def _schema_path(path=None):
+    """
+    path ของไฟล์ schema: ค่าที่ระบุ หรือไฟล์ที่ตั้งให้ scheming ไว้ล่าสุด
+    หรือสำเนาที่ commit มากับ extension
+    """
+    return path or _current_path or pkg_resources.resource_filename(
+        'ckanext.cdp', 'ckan_dataset_cdp.json')
+
+
+class CompiledChoices(object):
+    """
+    ข้อมูลของฟิลด์แบบ choice ที่คำนวณไว้ครั้งเดียว: ``values`` (frozenset สำหรับ
+    ตรวจค่า), ``order`` (value ตามลำดับใน schema สำหรับเรียงค่าที่เลือกหลายค่า),
+    ``labels`` (value -> label) และ ``validators`` (ชื่อ validator ที่ compile
+    ไว้ซึ่ง validators ของฟิลด์อ้างถึง)
+    """
+    __slots__ = ('field_name', 'values', 'order', 'labels', 'required',
+                 'validators')
+
+    def __init__(self, field):
+        choices = field['choices']
+        self.field_name = field['field_name']
+        self.values = frozenset(choice['value'] for choice in choices)
+        self.order = tuple(choice['value'] for choice in choices)
+        self.labels = dict(
+            (choice['value'], choice.get('label')) for choice in choices)
+        self.required = bool(field.get('required'))
+        names = set(prefix + self.field_name
+                    for prefix in SCHEMING_CHOICE_VALIDATORS.values())
+        self.validators = tuple(
+            token for token in field.get('validators', '').split()
+            if token in names)
+
+    def label(self, value):
+        return self.labels.get(value, value)
+
+
+def _single_choice_validator(compiled):
+    # ผลลัพธ์และข้อความ error เหมือน scheming_choices
+    def validator(value):
+        if value is toolkit.missing or not value:
+            return value
+        if value in compiled.values:
+            return value
+        raise toolkit.Invalid(
+            toolkit._('unexpected choice "{value}"').format(value=value))
+    return validator
+
+
+def _multiple_choice_validator(compiled):
+    # ผลลัพธ์และข้อความ error เหมือน scheming_multiple_choice: JSON list
+    # เรียงตามลำดับใน schema
+    def validator(key, data, errors, context):
+        if errors[key]:
+            return
+        value = data[key]
+        if value is not toolkit.missing:
+            if isinstance(value, str):
+                value = [value]
+            elif not isinstance(value, list):
+                errors[key].append(toolkit._('expecting list of strings'))
+                return
+        else:
+            value = []
+        selected = set()
+        for element in value:
+            if element in compiled.values:
+                selected.add(element)
+                continue
+            errors[key].append(
+                toolkit._('unexpected choice "%s"') % element)
+        if not errors[key]:
+            data[key] = json.dumps(
+                [v for v in compiled.order if v in selected])
+            if compiled.required and not selected:
+                errors[key].append(toolkit._('Select at least one'))
+    return validator
+
+
+_compiled_choices = {}
+
+
+def compiled_choices(path=None):
+    """
+    คืน dict field_name -> CompiledChoices ของทุกฟิลด์ที่มี choices
+    (ทั้ง dataset และ resource) สร้างครั้งเดียวต่อไฟล์ schema
+    """
+    path = _schema_path(path)
+    compiled = _compiled_choices.get(path)
+    if compiled is None:
+        with io.open(path, encoding='utf-8') as f:
+            schema = json.load(f)
+        compiled = dict(
+            (field['field_name'], CompiledChoices(field))
+            for field in schema.get('dataset_fields', []) +
+            schema.get('resource_fields', [])
+            if field.get('choices'))
+        _compiled_choices[path] = compiled
+    return compiled
+
+
+def choice_validators(path=None):
+    """
+    คืน validator สำหรับลงทะเบียนผ่าน IValidators เฉพาะตัวที่ schema อ้างถึง:
+    ``cdp_choice_<field>`` (แทน scheming_choices) หรือ
+    ``cdp_multiple_choice_<field>`` (แทน scheming_multiple_choice)
+    """
+    builders = {
+        CHOICE_VALIDATOR_PREFIX: _single_choice_validator,
+        MULTIPLE_CHOICE_VALIDATOR_PREFIX: _multiple_choice_validator,
+    }
+    validators = {}
+    for name, choices in compiled_choices(path).items():
+        for validator_name in choices.validators:
+            prefix = validator_name[:-len(name)]
+            validator = builders[prefix](choices)
+            validator.__name__ = validator_name
+            validators[validator_name] = validator
+    return validators
+
+
+def choice_label(field_name, value):
+    """
+    คืน label ของ value ในฟิลด์ field_name (หรือ value เองถ้าไม่อยู่ใน choices)
+    """
+    compiled = compiled_choices().get(field_name)
+    return compiled.label(value) if compiled is not None else value
+
+
+def scheming_schema_url():
+    """
+    คืนค่าสำหรับ config 'scheming.dataset_schemas'
+
+    scheming รองรับรูปแบบ '<module>:<path>' และจะ join path กับโฟลเดอร์ของ module
+    ถ้า path เป็น absolute จะได้ path นั้นตรงๆ จึงชี้ไปที่ไฟล์ใน cache ได้
+    """
+    global _current_path
+    try:
+        _current_path = merged_schema_path()
+        return 'ckanext.cdp:' + _current_path
+    except (ImportError, IOError, OSError) as e:
+        log.warning('Could not build the CDP schema from ckanext.thai_gdc '
+                    '(%s), using the bundled copy', e)
+        _current_path = None
+        return BUNDLED_SCHEMA
+
 def save_merged_schema():
     """
     สร้าง schema ใหม่โดย:
       - โหลด schema เดิมจาก thai_gdc
       - รวมฟิลด์ custom 'data_cdp'
       - แปลงข้อมูลให้อยู่ในรูปแบบที่ serialize ได้
-      - บันทึกผลลัพธ์ลงในไฟล์ 'ckan_dataset_cdp.json'
+      - บันทึกผลลัพธ์ลงในไฟล์ 'ckan_dataset_cdp.json' (สำเนาสำรองที่ commit มากับ extension)
     """
     original_schema = load_original_schema()
     merged_schema = merge_custom_field(original_schema)
     merged_schema = serialize_schema(merged_schema)
     cdp_schema_path = pkg_resources.resource_filename('ckanext.cdp', 'ckan_dataset_cdp.json')
-    with codecs.open(cdp_schema_path, 'w', encoding='utf-8') as f:
+    with io.open(cdp_schema_path, 'w', encoding='utf-8') as f:
         json.dump(merged_schema, f, indent=4, ensure_ascii=False)
-    return merged_schema
\ No newline at end of file
+    return merged_schema
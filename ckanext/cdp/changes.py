@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""
+เก็บค่าก่อนและหลังการแก้ไขของ extras ที่สนใจ (เช่น data_cdp)
+
+ค่าเก่าของ PackageExtra หาได้จาก attribute history ของ SQLAlchemy ก่อน flush
+เท่านั้น listener ``before_flush`` จึงจดคู่ (ค่าเก่า, ค่าใหม่) ของ key ที่ลงทะเบียน
+ด้วย track() ไว้ใน ``Session.info`` แล้ว hook ที่ทำงานหลัง flush
+(after_update) เรียก pop_change() เพื่ออ่านค่านั้นโดยไม่ต้อง query เพิ่ม
+
+รายการที่ไม่มีใครอ่านจะถูกล้างเมื่อ transaction commit หรือ rollback
+
+นอกจากนี้ยังมี registry ให้ handler subscribe การเปลี่ยนแปลงของ field
+แต่ละตัว (subscribe()) แล้ว hook เรียก dispatch() ซึ่งจะเรียกเฉพาะ handler
+ของ field ที่เปลี่ยนจริง การแก้ไข dataset ที่ไม่แตะ field เหล่านั้นจึงไม่ต้องทำงานเพิ่ม
+handler ที่ subscribe หลาย field ถูกเรียกครั้งเดียวพร้อม field ที่เปลี่ยนทั้งหมด
+"""
+import itertools
+
+from sqlalchemy import event
+from sqlalchemy.orm import attributes
+
+from ckan import model
+
+INFO_KEY = 'cdp_changes'
+
+_tracked = set()
+_listening = False
+# key -> list ของ handler(context, pkg_dict, changed)
+_subscribers = {}
+
+
+def track(*keys):
+    """
+    เริ่มจดการเปลี่ยนแปลงของ extras ที่มี key ตามที่ระบุ
+    """
+    _tracked.update(keys)
+    _listen()
+
+
+def _listen():
+    global _listening
+    if _listening:
+        return
+    event.listen(model.Session, 'before_flush', _before_flush)
+    event.listen(model.Session, 'after_commit', _clear)
+    event.listen(model.Session, 'after_rollback', _clear)
+    _listening = True
+
+
+def _old_and_new(session, extra):
+    if extra in session.new:
+        old = None
+    else:
+        value = attributes.get_history(extra, 'value')
+        state = attributes.get_history(extra, 'state')
+        old_value = value.deleted[0] if value.deleted else extra.value
+        old_state = state.deleted[0] if state.deleted else extra.state
+        old = old_value if old_state == 'active' else None
+    if extra in session.deleted or extra.state != 'active':
+        new = None
+    else:
+        new = extra.value
+    return old, new
+
+
+def _before_flush(session, flush_context, instances):
+    if not _tracked:
+        return
+    for obj in itertools.chain(session.new, session.dirty, session.deleted):
+        if not isinstance(obj, model.PackageExtra) or obj.key not in _tracked:
+            continue
+        package = getattr(obj, 'package', None)
+        package_id = obj.package_id or (package.id if package else None)
+        if package_id is None:
+            # dataset ใหม่ที่ยังไม่มี id ค่าเก่าเป็น None อยู่แล้ว
+            continue
+        old, new = _old_and_new(session, obj)
+        pending = session.info.setdefault(INFO_KEY, {})
+        key = (package_id, obj.key)
+        if key in pending:
+            # flush หลายรอบใน transaction เดียว: เก็บค่าเก่าของรอบแรกไว้
+            old = pending[key][0]
+        if old == new:
+            pending.pop(key, None)
+        else:
+            pending[key] = (old, new)
+
+
+def _clear(session):
+    session.info.pop(INFO_KEY, None)
+
+
+def pop_change(package_id, key):
+    """
+    คืน (ค่าเก่า, ค่าใหม่) ของ extra ``key`` ของ dataset ที่เปลี่ยนใน
+    transaction ปัจจุบัน หรือ None ถ้าไม่มีการเปลี่ยนแปลง
+    """
+    pending = model.Session().info.get(INFO_KEY)
+    if not pending:
+        return None
+    return pending.pop((package_id, key), None)
+
+
+def subscribe(key, handler):
+    """
+    ลงทะเบียน handler(context, pkg_dict, changed) ให้ถูกเรียกเมื่อ extra
+    ``key`` ของ dataset เปลี่ยน (ลงทะเบียน handler เดิมซ้ำจะไม่มีผล)
+
+    changed เป็น dict key -> (ค่าเก่า, ค่าใหม่) ของ field ที่เปลี่ยนในการบันทึก
+    ครั้งนั้นซึ่ง handler subscribe ไว้
+    """
+    track(key)
+    handlers = _subscribers.setdefault(key, [])
+    if handler not in handlers:
+        handlers.append(handler)
+
+
+def unsubscribe(handler):
+    """
+    ยกเลิกการลงทะเบียน handler จากทุก field (เช่นก่อน subscribe ใหม่เมื่อกฎเปลี่ยน)
+    """
+    for key, handlers in list(_subscribers.items()):
+        if handler in handlers:
+            handlers.remove(handler)
+        if not handlers:
+            del _subscribers[key]
+
+
+def field_value(pkg_dict, key):
+    """
+    อ่านค่าของ field จาก dict ของ dataset ทั้งแบบ field ปกติ (scheming)
+    และแบบอยู่ใน list ``extras``
+    """
+    if key in pkg_dict:
+        return pkg_dict[key]
+    for extra in pkg_dict.get('extras') or []:
+        if extra.get('key') == key:
+            return extra.get('value')
+    return None
+
+
+def dispatch(context, pkg_dict, created):
+    """
+    เรียก handler ของ field ที่เปลี่ยนในการบันทึกครั้งนี้ คืน list ของผลลัพธ์
+    (handler ละหนึ่งค่า)
+
+    สำหรับ dataset ใหม่ field ที่มีค่าถือว่าเปลี่ยนจาก None สำหรับการแก้ไข
+    ใช้ค่าที่ before_flush จดไว้ จึงไม่มีการ query เพิ่ม
+    """
+    package_id = pkg_dict.get('id')
+    # handler -> {key: (old, new)} ตามลำดับที่ subscribe
+    pending = {}
+    for key, handlers in _subscribers.items():
+        if created:
+            new = field_value(pkg_dict, key)
+            change = (None, new) if new is not None else None
+        else:
+            change = pop_change(package_id, key)
+        if change is None:
+            continue
+        for handler in handlers:
+            pending.setdefault(handler, {})[key] = change
+    return [handler(context, pkg_dict, changed)
+            for handler, changed in pending.items()]
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+import json
+
+import click
+
+from ckanext.cdp import collaborator, feed, principal, rules
+
+
+def get_commands():
+    return [cdp]
+
+
+@click.group()
+def cdp():
+    """ckanext-cdp management commands.
+    """
+    pass
+
+
+@cdp.command()
+@click.option('--chunk-size', default=1000, show_default=True,
+              help='Number of datasets reconciled per transaction.')
+@click.option('--dry-run', is_flag=True,
+              help='Only count the changes that would be made.')
+@click.option('--start-after', default=None, metavar='PACKAGE_ID',
+              help='Resume after this package id (printed in progress).')
+def reconcile(chunk_size, dry_run, start_after):
+    """Backfill collaborators from the consent rules (data_cdp by default).
+
+    Compares package_extra with package_member directly and applies the
+    differences in set-based statements, one chunk of datasets at a time.
+    """
+    ruleset = rules.get_ruleset()
+    user_ids = ruleset.user_ids()
+    totals = {'added': 0, 'updated': 0, 'removed': 0}
+    processed = 0
+
+    for lower, upper, size in collaborator.iter_package_chunks(
+            chunk_size, start_after):
+        counts = {'added': 0, 'updated': 0, 'removed': 0}
+        for name in ruleset.users:
+            user_counts = collaborator.reconcile_range(
+                user_ids[name], ruleset.predicates(name), lower, upper,
+                dry_run=dry_run)
+            for key, value in user_counts.items():
+                counts[key] += value
+                totals[key] += value
+        processed += size
+        click.echo(
+            u'{} datasets processed, last id {}: '
+            u'+{added} ~{updated} -{removed}'.format(
+                processed, upper, **counts))
+
+    click.secho(
+        u'{}Done. {} datasets: {added} added, {updated} updated, '
+        u'{removed} removed'.format(
+            u'[dry run] ' if dry_run else u'', processed, **totals),
+        fg=u'green')
+
+
+@cdp.command()
+@click.option('--cursor', default=None,
+              help='Cursor printed by the previous run, or an ISO timestamp.')
+@click.option('--output', type=click.File('w'), default='-',
+              show_default=True, help='File to write the JSON Lines to.')
+def changes(cursor, output):
+    """Export datasets changed since CURSOR as JSON Lines.
+
+    The cursor to use for the next run is printed to stderr.
+    """
+    try:
+        feed.parse_cursor(cursor)
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint='--cursor')
+
+    count = 0
+    for change in feed.iter_changes(principal.get_user_id(), cursor):
+        output.write(json.dumps(change) + '\n')
+        cursor = change['cursor']
+        count += 1
+
+    click.echo(u'{} changes exported, next cursor: {}'.format(
+        count, cursor or u''), err=True)
@@ -0,0 +1,322 @@
+# -*- coding: utf-8 -*-
+"""
+Reconciliation engine สำหรับ collaborator ของ dataset
+
+แทนการเรียก package_collaborator_create_any แล้วตามด้วย
+package_collaborator_delete_any ทุกครั้ง (ซึ่งทำให้เกิด lookup และ commit ซ้ำ)
+engine นี้จะอ่านแถว PackageMember ปัจจุบันเพียงครั้งเดียว เทียบกับสถานะที่ต้องการ
+แล้วเขียนอย่างมากหนึ่งครั้ง และไม่ commit เลยถ้าสถานะตรงกันอยู่แล้ว
+reconcile_package ทำแบบเดียวกันสำหรับหลาย user (หลายกฎใน rules.py) พร้อมกัน
+"""
+import datetime
+import logging
+
+from sqlalchemy import (
+    and_, case, exists, func, literal, not_, or_, select, tuple_,
+)
+from sqlalchemy.dialects import postgresql
+
+from ckan import model
+
+from ckanext.cdp.model import cdp_revocation_table
+
+log = logging.getLogger(__name__)
+
+# ผลลัพธ์ที่ reconcile_collaborator คืนค่า
+ADDED = 'added'
+UPDATED = 'updated'
+REMOVED = 'removed'
+NOOP = 'noop'
+# งานถูกเลื่อนไปทำทีหลัง (batch หรือ background job)
+DEFERRED = 'deferred'
+
+
+def reconcile_collaborator(context, package_id, user_id, capacity):
+    """
+    ปรับสถานะ collaborator ของ user_id บน package_id ให้ตรงกับที่ต้องการ
+
+    capacity เป็นระดับสิทธิ์ที่ต้องการ (เช่น 'editor') หรือ None ถ้าต้องการให้
+    user ไม่เป็น collaborator ของ dataset นี้ คืนค่าเป็นหนึ่งใน ADDED, UPDATED,
+    REMOVED หรือ NOOP
+    """
+    return reconcile_package(context, package_id, {user_id: capacity})[user_id]
+
+
+def reconcile_package(context, package_id, desired):
+    """
+    ปรับ collaborator หลายคนของ package_id พร้อมกัน
+
+    desired เป็น dict user_id -> capacity ที่ต้องการ (None = ไม่เป็น collaborator)
+    อ่านแถวปัจจุบันของทุก user ด้วย query เดียว แล้วเขียนด้วย upsert หนึ่งคำสั่ง
+    และ delete หนึ่งคำสั่ง (เท่าที่จำเป็น) คืน dict user_id -> ผลลัพธ์
+    """
+    # อ่านสถานะปัจจุบันหนึ่งครั้งเพื่อข้ามการเขียนเมื่อไม่มีอะไรเปลี่ยน การเขียนจริง
+    # ใช้ upsert/delete คำสั่งเดียว จึงไม่ชนกันแม้ worker อื่นเขียนแถวเดียวกัน
+    # ระหว่างอ่านกับเขียน
+    current = get_capacities(package_id, list(desired))
+    now = datetime.datetime.utcnow()
+    results = {}
+    rows = []
+    pairs = []
+    for user_id, capacity in desired.items():
+        existing = current.get(user_id)
+        if existing == capacity:
+            results[user_id] = NOOP
+        elif capacity is None:
+            pairs.append((package_id, user_id))
+            results[user_id] = REMOVED
+        else:
+            rows.append({
+                'package_id': package_id,
+                'user_id': user_id,
+                'capacity': capacity,
+                'modified': now,
+            })
+            results[user_id] = ADDED if existing is None else UPDATED
+
+    if not rows and not pairs:
+        return results
+    upsert_members(rows)
+    delete_members(pairs)
+
+    # commit เฉพาะเมื่อมีการเขียนจริง และเคารพ defer_commit ของ context
+    if not context.get('defer_commit'):
+        model.repo.commit()
+
+    for user_id, result in results.items():
+        if result != NOOP:
+            log.info('Collaborator %s %s on package %s (%s)',
+                     user_id, result, package_id, desired[user_id])
+    return results
+
+
+def get_capacity(package_id, user_id):
+    """
+    คืน capacity ปัจจุบันของ user_id บน package_id หรือ None ถ้าไม่ได้เป็น
+    collaborator
+    """
+    return model.Session.query(model.PackageMember.capacity). \
+        filter(model.PackageMember.package_id == package_id). \
+        filter(model.PackageMember.user_id == user_id).scalar()
+
+
+def get_capacities(package_id, user_ids):
+    """
+    คืน dict user_id -> capacity ของ user_ids ที่เป็น collaborator ของ
+    package_id อยู่ (query เดียว)
+    """
+    return dict(model.Session.query(
+        model.PackageMember.user_id, model.PackageMember.capacity).
+        filter(model.PackageMember.package_id == package_id).
+        filter(model.PackageMember.user_id.in_(user_ids)))
+
+
+def _in_range(column, lower, upper):
+    clauses = [column <= upper]
+    if lower is not None:
+        clauses.append(column > lower)
+    return and_(*clauses)
+
+
+def _matches(field, value, package_column):
+    """
+    เงื่อนไข EXISTS ว่า dataset ของ package_column มี extra ``field`` เท่ากับ
+    ``value``
+    """
+    extra = model.package_extra_table
+    return exists().where(and_(
+        extra.c.package_id == package_column,
+        extra.c.key == field,
+        extra.c.value == value,
+        extra.c.state == 'active',
+    ))
+
+
+def _wanted(predicates, package_column):
+    """
+    คืน (เงื่อนไขว่าต้องเป็น collaborator, capacity ที่ต้องการ) ของ dataset
+    ตาม predicates ซึ่งเป็น list ของ (field, value, capacity) เรียงตามลำดับ
+    ความสำคัญ ถ้าตรงหลาย predicate ใช้ capacity ของตัวแรก
+    """
+    conditions = [_matches(field, value, package_column)
+                  for field, value, _ in predicates]
+    capacity = case(
+        [(condition, literal(predicate[2]))
+         for condition, predicate in zip(conditions, predicates)])
+    return or_(*conditions), capacity
+
+
+def reconcile_range(user_id, predicates, lower, upper, dry_run=False):
+    """
+    ปรับตาราง package_member ของ user_id สำหรับ dataset ในช่วง id
+    (lower, upper] ด้วยคำสั่ง INSERT/UPDATE/DELETE แบบ set-based อย่างละหนึ่งคำสั่ง
+
+    predicates เป็น list ของ (field, value, capacity) ของ user นี้
+    (ดู rules.RuleSet.predicates) คืนค่า dict จำนวนแถว ``added``, ``updated``
+    และ ``removed`` ถ้า dry_run เป็น True จะนับจำนวนที่จะเปลี่ยนโดยไม่เขียนจริง
+    """
+    return _reconcile_scope(
+        user_id, predicates,
+        lambda column: _in_range(column, lower, upper), dry_run)
+
+
+def reconcile_packages(user_id, predicates, package_ids, chunk_size=1000):
+    """
+    เหมือน reconcile_range แต่จำกัดเฉพาะ dataset ใน package_ids
+    (แบ่งเป็นชุดละ chunk_size id เพื่อไม่ให้ IN list ยาวเกินไป)
+    """
+    package_ids = sorted(set(package_ids))
+    totals = {'added': 0, 'updated': 0, 'removed': 0}
+    for start in range(0, len(package_ids), chunk_size):
+        chunk = package_ids[start:start + chunk_size]
+        counts = _reconcile_scope(
+            user_id, predicates, lambda column: column.in_(chunk))
+        for key, count in counts.items():
+            totals[key] += count
+    return totals
+
+
+def _reconcile_scope(user_id, predicates, scope, dry_run=False):
+    package = model.package_table
+    member = model.package_member_table
+    existing = select([member.c.package_id]).where(
+        member.c.user_id == user_id)
+
+    wanted, capacity = _wanted(predicates, package.c.id)
+    to_add = and_(
+        scope(package.c.id),
+        wanted,
+        package.c.id.notin_(existing))
+    member_wanted, member_capacity = _wanted(predicates, member.c.package_id)
+    to_update = and_(
+        member.c.user_id == user_id,
+        scope(member.c.package_id),
+        member_wanted,
+        member.c.capacity != member_capacity)
+    to_remove = and_(
+        member.c.user_id == user_id,
+        scope(member.c.package_id),
+        not_(member_wanted))
+
+    if dry_run:
+        count = lambda q: model.Session.execute(
+            select([func.count()]).select_from(q)).scalar()
+        return {
+            'added': count(select([package.c.id]).where(to_add).alias()),
+            'updated': count(select([member.c.package_id]).where(
+                to_update).alias()),
+            'removed': count(select([member.c.package_id]).where(
+                to_remove).alias()),
+        }
+
+    now = datetime.datetime.utcnow()
+    rows = select([
+        package.c.id, literal(user_id), capacity, literal(now),
+    ]).where(to_add)
+    columns = ['package_id', 'user_id', 'capacity', 'modified']
+    # แถวที่ hook ของ worker อื่นเพิ่งเพิ่มระหว่างนี้ไม่ถือเป็น error
+    if _dialect(model.Session) == 'postgresql':
+        insert = postgresql.insert(member).from_select(
+            columns, rows).on_conflict_do_nothing()
+    else:
+        insert = member.insert().prefix_with('OR IGNORE').from_select(
+            columns, rows)
+    added = model.Session.execute(insert).rowcount
+    updated = model.Session.execute(member.update().where(to_update).values(
+        capacity=member_capacity, modified=now)).rowcount
+    record_revocations(to_remove, now)
+    removed = model.Session.execute(
+        member.delete().where(to_remove)).rowcount
+    model.repo.commit()
+    return {'added': added, 'updated': updated, 'removed': removed}
+
+
+def iter_package_chunks(chunk_size, start_after=None):
+    """
+    วนคืนช่วง id ของ dataset ครั้งละ chunk_size รายการ เรียงตาม id
+    (keyset pagination) เป็น tuple (lower, upper, จำนวน dataset ในช่วง)
+    """
+    package = model.package_table
+    lower = start_after
+    while True:
+        query = select([package.c.id]).order_by(package.c.id).limit(
+            chunk_size)
+        if lower is not None:
+            query = query.where(package.c.id > lower)
+        ids = [row[0] for row in model.Session.execute(query)]
+        if not ids:
+            return
+        yield lower, ids[-1], len(ids)
+        lower = ids[-1]
+
+
+def upsert_members(rows, connection=None):
+    """
+    เพิ่มหรือแก้ไขแถว package_member หลายแถวด้วยคำสั่งเดียว
+
+    rows เป็น list ของ dict ที่มี package_id, user_id, capacity และ modified
+    ใช้ INSERT ... ON CONFLICT DO UPDATE บน PostgreSQL และ INSERT OR REPLACE
+    บน SQLite จึงไม่เกิด duplicate key เมื่อหลาย worker เพิ่มแถวเดียวกันพร้อมกัน
+    ถ้าไม่ระบุ connection จะใช้ model.Session
+    """
+    if not rows:
+        return 0
+    bind = connection if connection is not None else model.Session
+    member = model.package_member_table
+    if _dialect(bind) == 'postgresql':
+        stmt = postgresql.insert(member).values(rows)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[member.c.package_id, member.c.user_id],
+            set_={'capacity': stmt.excluded.capacity,
+                  'modified': stmt.excluded.modified})
+    else:
+        stmt = member.insert().prefix_with('OR REPLACE').values(rows)
+    return bind.execute(stmt).rowcount
+
+
+def delete_members(pairs, connection=None):
+    """
+    ลบแถว package_member ของคู่ (package_id, user_id) ทั้งหมดด้วยคำสั่งเดียว
+    (และจดเวลาถอนสิทธิ์ด้วย record_revocations) คืนจำนวนแถวที่ถูกลบจริง
+    """
+    if not pairs:
+        return 0
+    bind = connection if connection is not None else model.Session
+    member = model.package_member_table
+    if len(pairs) == 1:
+        (package_id, user_id), = pairs
+        condition = and_(member.c.package_id == package_id,
+                         member.c.user_id == user_id)
+    else:
+        condition = tuple_(member.c.package_id, member.c.user_id).in_(pairs)
+    record_revocations(condition, datetime.datetime.utcnow(), bind)
+    return bind.execute(member.delete().where(condition)).rowcount
+
+
+def record_revocations(condition, revoked, connection=None):
+    """
+    จดเวลาถอนสิทธิ์ของแถว package_member ที่ตรง condition ลงตาราง
+    cdp_revocation ด้วยคำสั่งเดียว (เรียกก่อนลบแถวใน transaction เดียวกัน)
+    เพื่อให้ change feed เห็นการถอนสิทธิ์ที่ไม่ได้แก้ metadata_modified ของ dataset
+    """
+    bind = connection if connection is not None else model.Session
+    member = model.package_member_table
+    revocation = cdp_revocation_table
+    rows = select([member.c.package_id, member.c.user_id,
+                   literal(revoked)]).where(condition)
+    columns = ['package_id', 'user_id', 'revoked']
+    if _dialect(bind) == 'postgresql':
+        stmt = postgresql.insert(revocation).from_select(columns, rows)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[revocation.c.package_id, revocation.c.user_id],
+            set_={'revoked': stmt.excluded.revoked})
+    else:
+        stmt = revocation.insert().prefix_with('OR REPLACE').from_select(
+            columns, rows)
+    return bind.execute(stmt).rowcount
+
+
+def _dialect(bind):
+    if bind is model.Session:
+        bind = model.Session.get_bind()
+    return bind.dialect.name
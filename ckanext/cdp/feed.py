@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""
+Change feed ของ dataset สำหรับ CDP pipeline
+
+คืน dataset ที่ metadata (``package.metadata_modified``) หรือสิทธิ์ของ CDP user
+(``package_member.modified`` หรือเวลาถอนสิทธิ์ใน ``cdp_revocation``) เปลี่ยน
+หลังจาก cursor ที่กำหนด เรียงตามเวลาที่เปลี่ยนและ id เพื่อให้ใช้ cursor ต่อได้
+โดยไม่ข้ามหรือซ้ำ การถอนสิทธิ์โดย batch, ``ckan cdp reconcile`` หรือ background
+job ซึ่งไม่แก้ metadata_modified จึงยังอยู่ใน feed
+
+ผลลัพธ์ถูกอ่านจาก server-side cursor (``stream_results``) ทีละ batch
+จึงไม่ต้องสร้าง list ขนาดใหญ่ไว้ในหน่วยความจำ
+"""
+import datetime
+import json
+
+from sqlalchemy import and_, case, or_, select
+
+from ckan import model
+
+from ckanext.cdp.model import cdp_revocation_table
+
+CURSOR_SEPARATOR = '|'
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+FETCH_SIZE = 500
+
+
+def format_cursor(changed_at, package_id):
+    return changed_at.strftime(TIMESTAMP_FORMAT) + CURSOR_SEPARATOR + \
+        package_id
+
+
+def parse_cursor(cursor):
+    """
+    แปลง cursor เป็น tuple (datetime, package_id)
+
+    cursor อาจเป็นค่าที่ได้จาก feed ครั้งก่อน (``<timestamp>|<package id>``)
+    หรือเป็นเวลาแบบ ISO 8601 อย่างเดียว ถ้ารูปแบบไม่ถูกต้องจะ raise ValueError
+    """
+    if not cursor:
+        return None, None
+    timestamp, _, package_id = cursor.partition(CURSOR_SEPARATOR)
+    for fmt in (TIMESTAMP_FORMAT, '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d'):
+        try:
+            return datetime.datetime.strptime(timestamp, fmt), \
+                package_id or None
+        except ValueError:
+            continue
+    raise ValueError('Invalid cursor: {}'.format(cursor))
+
+
+def _changes_query(user_id, since, since_id):
+    package = model.package_table
+    member = model.package_member_table
+    extra = model.package_extra_table
+
+    revocation = cdp_revocation_table
+
+    joined = package.outerjoin(member, and_(
+        member.c.package_id == package.c.id,
+        member.c.user_id == user_id)).outerjoin(revocation, and_(
+            revocation.c.package_id == package.c.id,
+            revocation.c.user_id == user_id))
+    # เวลาล่าสุดของ metadata, แถว package_member และการถอนสิทธิ์ (NULL = ไม่มี)
+    changed_at = case([
+        (and_(member.c.modified > package.c.metadata_modified,
+              or_(revocation.c.revoked.is_(None),
+                  member.c.modified >= revocation.c.revoked)),
+         member.c.modified),
+        (revocation.c.revoked > package.c.metadata_modified,
+         revocation.c.revoked),
+    ], else_=package.c.metadata_modified)
+    data_cdp = select([extra.c.value]).where(and_(
+        extra.c.package_id == package.c.id,
+        extra.c.key == 'data_cdp',
+        extra.c.state == 'active')).limit(1).as_scalar()
+
+    query = select([
+        package.c.id, package.c.name, package.c.state,
+        package.c.metadata_modified, member.c.capacity,
+        data_cdp.label('data_cdp'), changed_at.label('changed_at'),
+    ]).select_from(joined)
+
+    if since is not None:
+        if since_id:
+            after = or_(changed_at > since,
+                        and_(changed_at == since, package.c.id > since_id))
+        else:
+            after = changed_at > since
+        # ให้ index บนแต่ละ timestamp ช่วยกรองก่อนคำนวณ changed_at
+        query = query.where(and_(
+            or_(package.c.metadata_modified >= since,
+                member.c.modified >= since,
+                revocation.c.revoked >= since),
+            after))
+    return query.order_by(changed_at, package.c.id)
+
+
+def iter_changes(user_id, cursor=None, limit=None):
+    """
+    วนคืน dict ของ dataset ที่เปลี่ยนหลัง cursor แต่ละรายการมี ``cursor``
+    ที่ใช้เรียกต่อจากรายการนั้นได้
+    """
+    since, since_id = parse_cursor(cursor)
+    query = _changes_query(user_id, since, since_id)
+    if limit:
+        query = query.limit(limit)
+    result = model.Session.execute(
+        query.execution_options(stream_results=True))
+    try:
+        while True:
+            rows = result.fetchmany(FETCH_SIZE)
+            if not rows:
+                return
+            for row in rows:
+                yield {
+                    'id': row['id'],
+                    'name': row['name'],
+                    'state': row['state'],
+                    'data_cdp': row['data_cdp'],
+                    'cdp_capacity': row['capacity'],
+                    'metadata_modified':
+                        row['metadata_modified'].isoformat(),
+                    'cursor': format_cursor(row['changed_at'], row['id']),
+                }
+    finally:
+        result.close()
+
+
+def iter_json_lines(user_id, cursor=None, limit=None):
+    """
+    เหมือน iter_changes แต่คืนเป็นบรรทัด JSON Lines
+    """
+    for change in iter_changes(user_id, cursor, limit):
+        yield json.dumps(change) + '\n'
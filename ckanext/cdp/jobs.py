@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+Background job สำหรับ reconcile collaborator ของ CDP user
+
+เมื่อเปิด ``ckanext.cdp.async = true`` hook ของ plugin จะไม่เขียน
+package_member ใน request แต่จะส่งงานเข้า job queue ของ CKAN แทน งานถูกส่ง
+หลังจาก transaction ของการบันทึก commit แล้วเท่านั้น (ดู enqueue_after_commit)
+worker จึงเห็นค่าที่เพิ่งบันทึกเสมอ และไม่มีงานถ้าการบันทึก rollback
+
+ทุก job มี id ไม่ซ้ำกัน (``cdp-reconcile-<package id>-<uuid>``) และ Redis เก็บ
+id ของ job ล่าสุดของแต่ละ dataset ไว้ที่ key ``cdp-reconcile-<package id>``:
+  - ถ้า job นั้นยังรออยู่ในคิว (queued) จะไม่ enqueue ซ้ำ
+    (แก้ไข 10 ครั้งติดกันจึง reconcile เพียงครั้งเดียว)
+  - ถ้า job กำลังรันหรือจบแล้ว จะ enqueue job ใหม่ด้วย id ใหม่ ไม่เขียนทับ
+    ข้อมูลของ job ที่กำลังรัน และ job ใหม่จะเห็นค่าที่บันทึกระหว่างนั้น
+  - ถ้าสอง request enqueue พร้อมกันอาจได้สอง job ซึ่งไม่เป็นไร เพราะ job
+    อ่านค่าล่าสุดจากฐานข้อมูลตอนที่รัน (ดูกฎใน rules.py) การรันซ้ำจึงปลอดภัย
+"""
+import logging
+import uuid
+
+import ckan.lib.jobs as jobs
+import ckan.plugins.toolkit as toolkit
+from ckan import model
+
+from ckanext.cdp import collaborator, rules, transaction
+
+log = logging.getLogger(__name__)
+
+JOB_ID_PREFIX = 'cdp-reconcile-'
+# ชื่อของรายการที่พักไว้ใน transaction (ดู transaction.py)
+PENDING_NAME = 'cdp_reconcile'
+# อายุของ key ที่ชี้ไปยัง job ล่าสุด (วินาที) หมดอายุแล้วก็แค่ไม่ได้รวม job
+LATEST_JOB_TTL = 24 * 60 * 60
+
+
+def is_async():
+    return toolkit.asbool(toolkit.config.get('ckanext.cdp.async', False))
+
+
+def _queue_name():
+    return toolkit.config.get(
+        'ckanext.cdp.jobs_queue', jobs.DEFAULT_QUEUE_NAME)
+
+
+def job_id(package_id):
+    """
+    idempotency key ของ dataset หนึ่งๆ: ชื่อ key ใน Redis ที่เก็บ id ของ job
+    ล่าสุด และเป็นส่วนต้นของ id ของทุก job ของ dataset นั้น
+    """
+    return JOB_ID_PREFIX + package_id
+
+
+def enqueue_reconcile(package_id):
+    """
+    ส่งงาน reconcile ของ dataset เข้าคิว ถ้ายังไม่มีงานของ dataset เดียวกัน
+    รออยู่ในคิว (งานที่กำลังรันไม่นับ)
+
+    คืนค่า job ที่อยู่ในคิว (อาจเป็น job เดิมที่ถูกรวมเข้าด้วยกัน)
+    """
+    queue_name = _queue_name()
+    queue = jobs.get_queue(queue_name)
+    key = job_id(package_id)
+    latest = jobs.add_queue_name_prefix(key)
+    latest_id = queue.connection.get(latest)
+    if latest_id is not None:
+        if isinstance(latest_id, bytes):
+            latest_id = latest_id.decode('utf-8')
+        pending = queue.fetch_job(latest_id)
+        if pending is not None and pending.get_status() == 'queued':
+            log.debug('Coalesced CDP reconcile for package %s', package_id)
+            return pending
+    job = jobs.enqueue(
+        reconcile_package_job, [package_id],
+        title='CDP reconcile {}'.format(package_id),
+        queue=queue_name,
+        rq_kwargs={'job_id': '{}-{}'.format(key, uuid.uuid4().hex)})
+    queue.connection.set(latest, job.id, ex=LATEST_JOB_TTL)
+    return job
+
+
+def enqueue_after_commit(package_id):
+    """
+    ส่งงาน reconcile ของ dataset เข้าคิวเมื่อ transaction ปัจจุบัน commit
+    (เรียกจาก hook ของ plugin ซึ่งทำงานก่อน commit) ถ้า rollback จะไม่มีงาน
+    """
+    transaction.register(PENDING_NAME, _enqueue_committed)
+    transaction.stage(PENDING_NAME, package_id)
+
+
+def _enqueue_committed(package_ids):
+    seen = set()
+    for package_id in package_ids:
+        if package_id in seen:
+            continue
+        seen.add(package_id)
+        enqueue_reconcile(package_id)
+
+
+def reconcile_package_job(package_id):
+    """
+    job ที่รันใน worker: อ่านค่าล่าสุดของ field ที่กฎอ้างถึงแล้ว reconcile
+    user ของทุกกฎในครั้งเดียว
+    """
+    package = model.Package.get(package_id)
+    if package is None:
+        log.info('CDP reconcile skipped, package %s no longer exists',
+                 package_id)
+        return collaborator.NOOP
+    ruleset = rules.get_ruleset()
+    user_ids = ruleset.user_ids()
+    desired = ruleset.desired(package.extras.get)
+    results = collaborator.reconcile_package(
+        {}, package.id, dict((user_ids[name], capacity)
+                             for name, capacity in desired.items()))
+    changed = [result for result in results.values()
+               if result != collaborator.NOOP]
+    if not changed:
+        return collaborator.NOOP
+    return changed[0] if len(changed) == 1 else collaborator.UPDATED
@@ -0,0 +1,535 @@
+# -*- coding: utf-8 -*-
+import datetime
+import logging
+import re
+
+from sqlalchemy import or_, select, tuple_
+
+import ckan.authz as authz
+import ckan.lib.dictization.model_dictize as model_dictize
+import ckan.lib.helpers as h
+import ckan.logic as logic
+import ckan.plugins.toolkit as toolkit
+
+from ckanext.cdp import collaborator as cdp_collaborator
+from ckanext.cdp import audit, feed, metrics, principal, spatial
+from ckanext.cdp.model import cdp_audit_table
+
+log = logging.getLogger(__name__)
+ValidationError = logic.ValidationError
+NotFound = logic.NotFound
+_get_or_bust = logic.get_or_bust
+
+CAPACITIES = ('editor', 'member')
+DATASET_LIST_FIELDS = [
+    'id', 'name', 'title', 'metadata_modified', 'owner_org']
+CURSOR_RE = re.compile(r'^[\w-]+$')
+
+
+def get_actions():
+    return {
+        'package_collaborator_create_any': package_collaborator_create_any,
+        'package_collaborator_delete_any': package_collaborator_delete_any,
+        'package_collaborator_create_many': package_collaborator_create_many,
+        'package_collaborator_delete_many': package_collaborator_delete_many,
+        'cdp_dataset_list': cdp_dataset_list,
+        'cdp_change_feed': cdp_change_feed,
+        'cdp_audit_list': cdp_audit_list,
+        'cdp_bbox_search': cdp_bbox_search,
+    }
+
+
+@metrics.instrumented('package_collaborator_create_any')
+def package_collaborator_create_any(context, data_dict):
+    '''Make a user a collaborator in a dataset, regardless of the
+    dataset's own collaborator permissions.
+
+    Only sysadmins are authorized. In-process callers that act on behalf
+    of the extension must pass ``ignore_auth`` in the context.
+    '''
+
+    model = context['model']
+
+    toolkit.check_access('package_collaborator_create_any', context, data_dict)
+
+    package_id, user_id, capacity = _get_or_bust(
+        data_dict,
+        ['id', 'user_id', 'capacity']
+    )
+
+    package = model.Package.get(package_id)
+    if not package:
+        raise NotFound('Dataset not found')
+
+    user = model.User.get(user_id)
+    if not user:
+        raise NotFound('User not found')
+
+    # Upsert in one statement so concurrent calls cannot race on the insert
+    cdp_collaborator.upsert_members([{
+        'package_id': package.id,
+        'user_id': user.id,
+        'capacity': capacity,
+        'modified': datetime.datetime.utcnow(),
+    }])
+    # Audit records are staged in the transaction, so record before commit
+    audit.record(package.id, actor=context.get('user'),
+                 collaborator_user_id=user.id, capacity=capacity,
+                 result='granted')
+    model.repo.commit()
+    collaborator = model.Session.query(model.PackageMember). \
+        populate_existing(). \
+        filter(model.PackageMember.package_id == package.id). \
+        filter(model.PackageMember.user_id == user.id).one()
+
+    log.info('User %s added as collaborator in package %s (%s)',
+             user.name, package.id, capacity)
+
+    return model_dictize.member_dictize(collaborator, context)
+
+
+@metrics.instrumented('package_collaborator_delete_any')
+def package_collaborator_delete_any(context, data_dict):
+    '''Remove a collaborator from a dataset, regardless of the dataset's
+    own collaborator permissions.
+
+    Only sysadmins are authorized. In-process callers that act on behalf
+    of the extension must pass ``ignore_auth`` in the context.
+    '''
+
+    model = context['model']
+
+    toolkit.check_access('package_collaborator_delete_any', context, data_dict)
+
+    package_id, user_id = _get_or_bust(
+        data_dict,
+        ['id', 'user_id']
+    )
+
+    package = model.Package.get(package_id)
+    if not package:
+        raise NotFound('Package not found')
+
+    user = model.User.get(user_id)
+    if not user:
+        raise NotFound('User not found')
+
+    deleted = cdp_collaborator.delete_members([(package.id, user.id)])
+    if not deleted:
+        raise NotFound(
+            'User {} is not a collaborator on this package'.format(user_id))
+
+    audit.record(package.id, actor=context.get('user'),
+                 collaborator_user_id=user.id,
+                 result=cdp_collaborator.REMOVED)
+    model.repo.commit()
+
+    log.info('User %s removed as collaborator from package %s',
+             user_id, package.id)
+
+
+@metrics.instrumented('package_collaborator_create_many')
+def package_collaborator_create_many(context, data_dict):
+    '''Make users collaborators in many datasets with a single commit.
+
+    :param collaborators: list of dicts with ``id`` (dataset id or name),
+        ``user_id`` (user id or name) and ``capacity``
+    :type collaborators: list
+    :param ids: alternatively, a list of dataset ids or names that all get
+        the same ``user_id`` and ``capacity``
+    :type ids: list
+
+    :returns: one result dict per requested item, in order, with ``success``
+        and either ``result`` ('added', 'updated' or 'noop') or ``error``
+    :rtype: list
+    '''
+    model = context['model']
+
+    toolkit.check_access(
+        'package_collaborator_create_many', context, data_dict)
+
+    items = _collaborator_items(data_dict, with_capacity=True)
+    results, resolved = _resolve_items(model, items)
+
+    existing = _existing_capacities(model, resolved)
+    now = datetime.datetime.utcnow()
+    rows = {}
+    for index, (package_id, user_id, item) in resolved.items():
+        capacity = item['capacity']
+        if capacity not in CAPACITIES:
+            results[index] = _error(
+                item, 'Capacity must be one of {}'.format(CAPACITIES))
+            continue
+        current = existing.get((package_id, user_id))
+        if current == capacity:
+            outcome = cdp_collaborator.NOOP
+        else:
+            outcome = cdp_collaborator.ADDED if current is None \
+                else cdp_collaborator.UPDATED
+            rows[(package_id, user_id)] = {
+                'package_id': package_id, 'user_id': user_id,
+                'capacity': capacity, 'modified': now}
+        results[index] = dict(item, success=True, result=outcome)
+
+    if rows:
+        cdp_collaborator.upsert_members(list(rows.values()))
+        for row in rows.values():
+            audit.record(row['package_id'], actor=context.get('user'),
+                         collaborator_user_id=row['user_id'],
+                         capacity=row['capacity'], result='granted')
+        if not context.get('defer_commit'):
+            model.repo.commit()
+
+    log.info('%d collaborators added or updated in batch', len(rows))
+    return results
+
+
+@metrics.instrumented('package_collaborator_delete_many')
+def package_collaborator_delete_many(context, data_dict):
+    '''Remove users as collaborators from many datasets with a single commit.
+
+    :param collaborators: list of dicts with ``id`` (dataset id or name) and
+        ``user_id`` (user id or name)
+    :type collaborators: list
+    :param ids: alternatively, a list of dataset ids or names to remove
+        ``user_id`` from
+    :type ids: list
+
+    :returns: one result dict per requested item, in order, with ``success``
+        and either ``result`` ('removed') or ``error``
+    :rtype: list
+    '''
+    model = context['model']
+
+    toolkit.check_access(
+        'package_collaborator_delete_many', context, data_dict)
+
+    items = _collaborator_items(data_dict, with_capacity=False)
+    results, resolved = _resolve_items(model, items)
+
+    existing = _existing_capacities(model, resolved)
+    pairs = set()
+    for index, (package_id, user_id, item) in resolved.items():
+        if (package_id, user_id) not in existing:
+            results[index] = _error(
+                item, 'User {} is not a collaborator on this package'.format(
+                    item['user_id']))
+            continue
+        pairs.add((package_id, user_id))
+        results[index] = dict(
+            item, success=True, result=cdp_collaborator.REMOVED)
+
+    if pairs:
+        cdp_collaborator.delete_members(list(pairs))
+        for package_id, user_id in pairs:
+            audit.record(package_id, actor=context.get('user'),
+                         collaborator_user_id=user_id,
+                         result=cdp_collaborator.REMOVED)
+        if not context.get('defer_commit'):
+            model.repo.commit()
+
+    log.info('%d collaborators removed in batch', len(pairs))
+    return results
+
+
+@toolkit.side_effect_free
+def cdp_dataset_list(context, data_dict):
+    '''List datasets that consent to CDP, answered from the search index.
+
+    Pages are keyed on the dataset id, so each page is a cheap range query
+    no matter how deep the caller is in the list.
+
+    :param cursor: the ``next_cursor`` returned by the previous page
+    :type cursor: string
+    :param limit: page size (default 100, max 1000)
+    :type limit: int
+    :param fl: fields to return (default: id, name, title,
+        metadata_modified, owner_org), as a list or a comma separated
+        string
+    :type fl: list or string
+
+    :returns: ``results``, ``count`` (all matching datasets) and
+        ``next_cursor`` (None on the last page)
+    :rtype: dict
+    '''
+    toolkit.check_access('cdp_dataset_list', context, data_dict)
+
+    cursor = data_dict.get('cursor')
+    if cursor and not CURSOR_RE.match(cursor):
+        raise ValidationError({'cursor': ['Invalid cursor']})
+    try:
+        limit = int(data_dict.get('limit', 100))
+    except (TypeError, ValueError):
+        raise ValidationError({'limit': ['Must be an integer']})
+    limit = max(1, min(limit, 1000))
+    fl = data_dict.get('fl') or DATASET_LIST_FIELDS
+    # a GET request passes fl as a string
+    fl = fl.split(',') if isinstance(fl, str) else list(fl)
+    fl = [field.strip() for field in fl if field.strip()]
+    if 'id' not in fl:
+        fl = ['id'] + fl
+
+    fq = '+cdp_consent:yes'
+    if cursor:
+        fq += ' +id:{{"{}" TO *]'.format(cursor)
+    search = toolkit.get_action('package_search')(context.copy(), {
+        'q': '*:*',
+        'fq': fq,
+        'sort': 'id asc',
+        # one extra row tells whether there is a next page
+        'rows': limit + 1,
+        'fl': fl,
+        'include_private': True,
+    })
+    results = search['results'][:limit]
+    more = len(search['results']) > limit
+    return {
+        'results': results,
+        'count': search['count'],
+        'next_cursor': results[-1]['id'] if more else None,
+    }
+
+
+@toolkit.side_effect_free
+def cdp_change_feed(context, data_dict):
+    '''Datasets whose metadata or CDP collaborator row changed after a cursor.
+
+    For large deltas use the streaming ``/api/cdp/changes`` endpoint or
+    ``ckan cdp changes`` instead, which return the same records as
+    JSON Lines without a page limit.
+
+    :param cursor: the ``next_cursor`` of a previous call, or an ISO 8601
+        timestamp (default: from the beginning)
+    :type cursor: string
+    :param limit: maximum number of records (default 1000, max 10000)
+    :type limit: int
+
+    :returns: ``results`` and ``next_cursor`` (to pass on the next call)
+    :rtype: dict
+    '''
+    toolkit.check_access('cdp_change_feed', context, data_dict)
+
+    cursor = data_dict.get('cursor')
+    try:
+        feed.parse_cursor(cursor)
+    except ValueError:
+        raise ValidationError({'cursor': ['Invalid cursor']})
+    try:
+        limit = int(data_dict.get('limit', 1000))
+    except (TypeError, ValueError):
+        raise ValidationError({'limit': ['Must be an integer']})
+    limit = max(1, min(limit, 10000))
+
+    results = list(feed.iter_changes(principal.get_user_id(), cursor, limit))
+    return {
+        'results': results,
+        'next_cursor': results[-1]['cursor'] if results else cursor,
+    }
+
+
+@toolkit.side_effect_free
+def cdp_audit_list(context, data_dict):
+    '''History of CDP consent and collaborator changes, newest first.
+
+    Records are buffered in memory and written in batches, so the last few
+    seconds of changes may not be listed yet.
+
+    :param package_id: only changes of this dataset (id or name)
+    :type package_id: string
+    :param since: only changes at or after this ISO 8601 time
+    :type since: string
+    :param until: only changes before this ISO 8601 time
+    :type until: string
+    :param before_id: the ``next_before_id`` returned by the previous page
+    :type before_id: int
+    :param limit: page size (default 100, max 1000)
+    :type limit: int
+
+    :returns: ``results`` and ``next_before_id`` (None on the last page)
+    :rtype: dict
+    '''
+    model = context['model']
+
+    toolkit.check_access('cdp_audit_list', context, data_dict)
+
+    table = cdp_audit_table
+    query = select([table])
+    errors = {}
+
+    package_id = data_dict.get('package_id')
+    if package_id:
+        package = model.Package.get(package_id)
+        if not package:
+            raise NotFound('Dataset not found')
+        query = query.where(table.c.package_id == package.id)
+    since, until = (_audit_date(data_dict, key, errors)
+                    for key in ('since', 'until'))
+    if since:
+        query = query.where(table.c.created >= since)
+    if until:
+        query = query.where(table.c.created < until)
+    try:
+        limit = max(1, min(int(data_dict.get('limit', 100)), 1000))
+        before_id = data_dict.get('before_id')
+        if before_id is not None:
+            query = query.where(table.c.id < int(before_id))
+    except (TypeError, ValueError):
+        errors['limit'] = ['limit and before_id must be integers']
+    if errors:
+        raise ValidationError(errors)
+
+    rows = model.Session.execute(
+        query.order_by(table.c.id.desc()).limit(limit)).fetchall()
+    results = []
+    for row in rows:
+        result = dict(row)
+        result['created'] = result['created'].isoformat()
+        results.append(result)
+    return {
+        'results': results,
+        'next_before_id': results[-1]['id'] if len(results) == limit
+        else None,
+    }
+
+
+@toolkit.side_effect_free
+def cdp_bbox_search(context, data_dict):
+    '''Datasets whose bounding box matches a region.
+
+    Answered from an in-memory index of the ``*_bound_longitude`` fields,
+    built on the first call and kept up to date by the dataset hooks.
+    Private datasets are only returned to sysadmins.
+
+    :param bbox: the region as ``west,south,east,north`` in decimal degrees
+        (a string or a list of four numbers)
+    :type bbox: string
+    :param relation: ``intersects`` (default), ``contains`` (the dataset
+        box contains the region, e.g. a point) or ``within`` (the dataset
+        box lies inside the region)
+    :type relation: string
+    :param limit: maximum number of results (default 1000, max 10000)
+    :type limit: int
+    :param offset: number of results to skip (default 0)
+    :type offset: int
+
+    :returns: ``count`` (all matching datasets) and ``results``, a list of
+        ``{'id': ..., 'bbox': [west, south, east, north]}`` ordered by id
+    :rtype: dict
+    '''
+    toolkit.check_access('cdp_bbox_search', context, data_dict)
+
+    errors = {}
+    bbox = _get_or_bust(data_dict, 'bbox')
+    if isinstance(bbox, str):
+        bbox = bbox.split(',')
+    try:
+        bbox = tuple(float(value) for value in bbox)
+    except (TypeError, ValueError):
+        bbox = ()
+    if len(bbox) != 4 or bbox[0] > bbox[2] or bbox[1] > bbox[3]:
+        errors['bbox'] = ['Must be west,south,east,north']
+    relation = data_dict.get('relation', 'intersects')
+    if relation not in spatial.RELATIONS:
+        errors['relation'] = ['Must be one of {}'.format(
+            ', '.join(spatial.RELATIONS))]
+    try:
+        limit = max(1, min(int(data_dict.get('limit', 1000)), 10000))
+        offset = max(0, int(data_dict.get('offset', 0)))
+    except (TypeError, ValueError):
+        errors['limit'] = ['limit and offset must be integers']
+    if errors:
+        raise ValidationError(errors)
+
+    matches = spatial.get_index().search(
+        bbox, relation,
+        include_private=authz.is_sysadmin(context.get('user')))
+    return {
+        'count': len(matches),
+        'results': [{'id': package_id, 'bbox': list(box)}
+                    for package_id, box in matches[offset:offset + limit]],
+    }
+
+
+def _audit_date(data_dict, key, errors):
+    if not data_dict.get(key):
+        return None
+    try:
+        return h.date_str_to_datetime(data_dict[key])
+    except (TypeError, ValueError):
+        errors[key] = ['Must be an ISO 8601 date']
+
+
+def _collaborator_items(data_dict, with_capacity):
+    fields = ['id', 'user_id', 'capacity'] if with_capacity \
+        else ['id', 'user_id']
+    if 'collaborators' in data_dict:
+        items = data_dict['collaborators']
+        if not isinstance(items, list):
+            raise ValidationError({'collaborators': ['Must be a list']})
+        for item in items:
+            if not isinstance(item, dict) or \
+                    not all(item.get(field) for field in fields):
+                raise ValidationError({'collaborators': [
+                    'Each item must have {}'.format(', '.join(fields))]})
+        return [dict((field, item[field]) for field in fields)
+                for item in items]
+
+    ids = _get_or_bust(data_dict, 'ids')
+    if not isinstance(ids, list):
+        raise ValidationError({'ids': ['Must be a list']})
+    shared = dict((field, _get_or_bust(data_dict, field))
+                  for field in fields[1:])
+    return [dict(shared, id=package_id) for package_id in ids]
+
+
+def _resolve_items(model, items):
+    '''Resolve dataset and user references with one IN query each.
+
+    Returns the per-item result list (pre-filled for missing items) and a
+    dict of index -> (package id, user id, item) for the resolved ones.
+    '''
+    package_refs = set(item['id'] for item in items)
+    user_refs = set(item['user_id'] for item in items)
+
+    packages = {}
+    for package_id, name in model.Session.query(
+            model.Package.id, model.Package.name).filter(or_(
+                model.Package.id.in_(package_refs),
+                model.Package.name.in_(package_refs))):
+        packages[package_id] = packages[name] = package_id
+
+    users = {}
+    for user_id, name in model.Session.query(
+            model.User.id, model.User.name).filter(or_(
+                model.User.id.in_(user_refs),
+                model.User.name.in_(user_refs))):
+        users[user_id] = users[name] = user_id
+
+    results = [None] * len(items)
+    resolved = {}
+    for index, item in enumerate(items):
+        if item['id'] not in packages:
+            results[index] = _error(item, 'Dataset not found')
+        elif item['user_id'] not in users:
+            results[index] = _error(item, 'User not found')
+        else:
+            resolved[index] = (
+                packages[item['id']], users[item['user_id']], item)
+    return results, resolved
+
+
+def _existing_capacities(model, resolved):
+    pairs = set((package_id, user_id)
+                for package_id, user_id, _ in resolved.values())
+    if not pairs:
+        return {}
+    member = model.PackageMember
+    rows = model.Session.query(
+        member.package_id, member.user_id, member.capacity).filter(
+            tuple_(member.package_id, member.user_id).in_(pairs))
+    return dict(((package_id, user_id), capacity)
+                for package_id, user_id, capacity in rows)
+
+
+def _error(item, message):
+    return dict(item, success=False, error=message)
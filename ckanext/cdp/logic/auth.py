@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+import ckan.plugins.toolkit as toolkit
+
+from ckanext.cdp import principal
+
+
+def get_auth_functions():
+    return {
+        'package_collaborator_create_any': package_collaborator_create_any,
+        'package_collaborator_delete_any': package_collaborator_delete_any,
+        'package_collaborator_create_many': package_collaborator_create_many,
+        'package_collaborator_delete_many': package_collaborator_delete_many,
+        'cdp_dataset_list': cdp_dataset_list,
+        'cdp_change_feed': cdp_change_feed,
+        'cdp_audit_list': cdp_audit_list,
+        'cdp_bbox_search': cdp_bbox_search,
+    }
+
+
+# These actions bypass the dataset's own collaborator permissions, so over
+# the API they are restricted to sysadmins (who are always authorized).
+
+def package_collaborator_create_any(context, data_dict):
+    return {'success': False}
+
+
+def package_collaborator_delete_any(context, data_dict):
+    return {'success': False}
+
+
+def package_collaborator_create_many(context, data_dict):
+    return {'success': False}
+
+
+def package_collaborator_delete_many(context, data_dict):
+    return {'success': False}
+
+
+@toolkit.auth_allow_anonymous_access
+def cdp_dataset_list(context, data_dict):
+    # Same visibility as package_search: private datasets are filtered by
+    # the search permission labels of the calling user.
+    return {'success': True}
+
+
+def cdp_change_feed(context, data_dict):
+    # The feed lists private datasets too, so only the CDP user itself (and
+    # sysadmins) may read it.
+    return {'success': context.get('user') == principal.get_user_name()}
+
+
+def cdp_audit_list(context, data_dict):
+    # Audit history is for compliance staff, i.e. sysadmins only.
+    return {'success': False}
+
+
+@toolkit.auth_allow_anonymous_access
+def cdp_bbox_search(context, data_dict):
+    # Private datasets are left out of the results for non-sysadmins.
+    return {'success': True}
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+"""
+Instrumentation ของ hook และ action ของ CDP
+
+แต่ละ operation (เช่น ``after_update`` หรือ ``package_collaborator_create_many``)
+ถูกเก็บเป็น histogram ของเวลา (wall time) จำนวน SQL statement ที่รัน
+(นับด้วย SQLAlchemy event ``before_cursor_execute``) และจำนวนครั้งแยกตาม
+outcome (added/updated/removed/noop/deferred/ok/error)
+
+ตัวนับเป็นตัวแปรธรรมดาต่อ process ไม่มี lock ค่าเพิ่มทีละหนึ่งภายใต้ GIL
+ในกรณีที่ thread ชนกันพอดีอาจหายไปบ้างเล็กน้อย ซึ่งยอมรับได้สำหรับ metrics
+การบันทึกแต่ละครั้งจึงมีต้นทุนแค่การบวกเลขไม่กี่ตัว
+
+ถ้าตั้ง ``ckanext.cdp.statsd_host`` (``host:port``) จะส่งค่าไป statsd ผ่าน UDP ด้วย
+"""
+import bisect
+import functools
+import logging
+import socket
+import threading
+import time
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+import ckan.plugins.toolkit as toolkit
+
+log = logging.getLogger(__name__)
+
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+           2.5, 5.0)
+OUTCOMES = ('added', 'updated', 'removed', 'noop', 'deferred')
+
+_series = {}
+_local = threading.local()
+_listening = False
+_statsd = None
+
+
+class _Series(object):
+    __slots__ = ('count', 'seconds', 'queries', 'buckets', 'outcomes')
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.queries = 0
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.outcomes = {}
+
+
+def _on_cursor_execute(conn, cursor, statement, parameters, context,
+                       executemany):
+    _local.queries = getattr(_local, 'queries', 0) + 1
+
+
+def install():
+    """
+    เริ่มนับ SQL statement ของทุก engine (เรียกครั้งเดียวต่อ process)
+    """
+    global _listening
+    if not _listening:
+        event.listen(Engine, 'before_cursor_execute', _on_cursor_execute)
+        _listening = True
+
+
+def query_count():
+    """
+    จำนวน SQL statement ที่ thread นี้รันไปแล้วนับตั้งแต่ install()
+    """
+    return getattr(_local, 'queries', 0)
+
+
+def observe(name, seconds, queries, outcome):
+    series = _series.get(name)
+    if series is None:
+        series = _series.setdefault(name, _Series())
+    series.count += 1
+    series.seconds += seconds
+    series.queries += queries
+    series.buckets[bisect.bisect_left(BUCKETS, seconds)] += 1
+    series.outcomes[outcome] = series.outcomes.get(outcome, 0) + 1
+    if _statsd is not None:
+        _statsd.send(name, seconds, queries, outcome)
+
+
+def call(name, fn, *args, **kwargs):
+    """
+    เรียก fn แล้วบันทึกเวลา จำนวน query และ outcome ภายใต้ชื่อ name
+
+    outcome คือค่าที่ fn คืนถ้าเป็นหนึ่งใน OUTCOMES, 'ok' ถ้าเป็นค่าอื่น
+    และ 'error' ถ้า raise exception
+    """
+    start = time.perf_counter()
+    queries = query_count()
+    outcome = 'error'
+    try:
+        result = fn(*args, **kwargs)
+        outcome = result if result in OUTCOMES else 'ok'
+        return result
+    finally:
+        observe(name, time.perf_counter() - start,
+                query_count() - queries, outcome)
+
+
+def instrumented(name):
+    """
+    decorator ของ call() สำหรับ action function
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            return call(name, fn, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def reset():
+    _series.clear()
+
+
+def snapshot(name):
+    """
+    คืน dict ``count``, ``seconds`` และ ``queries`` สะสมของ operation name
+    """
+    series = _series.get(name) or _Series()
+    return {'count': series.count, 'seconds': series.seconds,
+            'queries': series.queries}
+
+
+def _format_float(value):
+    return repr(float(value))
+
+
+def prometheus_text():
+    """
+    แปลง metrics ทั้งหมดของ process นี้เป็น Prometheus text format
+    """
+    lines = [
+        '# HELP ckanext_cdp_duration_seconds Wall time of CDP hooks and '
+        'actions.',
+        '# TYPE ckanext_cdp_duration_seconds histogram',
+    ]
+    for name, series in sorted(_series.items()):
+        cumulative = 0
+        for bound, count in zip(BUCKETS + ('+Inf',), series.buckets):
+            cumulative += count
+            le = bound if bound == '+Inf' else _format_float(bound)
+            lines.append(
+                'ckanext_cdp_duration_seconds_bucket'
+                '{{operation="{}",le="{}"}} {}'.format(name, le, cumulative))
+        lines.append('ckanext_cdp_duration_seconds_sum{{operation="{}"}} {}'
+                     .format(name, _format_float(series.seconds)))
+        lines.append('ckanext_cdp_duration_seconds_count{{operation="{}"}} {}'
+                     .format(name, series.count))
+
+    lines += [
+        '# HELP ckanext_cdp_queries_total SQL statements run by CDP hooks '
+        'and actions.',
+        '# TYPE ckanext_cdp_queries_total counter',
+    ]
+    for name, series in sorted(_series.items()):
+        lines.append('ckanext_cdp_queries_total{{operation="{}"}} {}'.format(
+            name, series.queries))
+
+    lines += [
+        '# HELP ckanext_cdp_operations_total CDP hook and action calls by '
+        'outcome.',
+        '# TYPE ckanext_cdp_operations_total counter',
+    ]
+    for name, series in sorted(_series.items()):
+        for outcome, count in sorted(series.outcomes.items()):
+            lines.append(
+                'ckanext_cdp_operations_total'
+                '{{operation="{}",outcome="{}"}} {}'.format(
+                    name, outcome, count))
+    return '\n'.join(lines) + '\n'
+
+
+class StatsdEmitter(object):
+    """
+    ส่ง timing และตัวนับไป statsd แบบ fire-and-forget ผ่าน UDP
+    """
+
+    def __init__(self, host, port, prefix):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def send(self, name, seconds, queries, outcome):
+        key = '{}.{}'.format(self.prefix, name)
+        payload = '{0}.time:{1:.3f}|ms\n{0}.queries:{2}|c\n' \
+            '{0}.{3}:1|c'.format(key, seconds * 1000, queries, outcome)
+        try:
+            self.socket.sendto(payload.encode('ascii'), self.address)
+        except (socket.error, UnicodeError) as e:
+            log.debug('statsd send failed: %s', e)
+
+
+def configure(config):
+    """
+    ตั้งค่า statsd emitter จาก config (เรียกจาก update_config)
+    """
+    global _statsd
+    install()
+    target = config.get('ckanext.cdp.statsd_host')
+    if not target:
+        _statsd = None
+        return
+    host, _, port = target.partition(':')
+    _statsd = StatsdEmitter(
+        host, toolkit.asint(port or 8125),
+        config.get('ckanext.cdp.statsd_prefix', 'ckanext.cdp'))
@@ -0,0 +1,40 @@
+"""Create cdp_audit
+
+Revision ID: 3a1f0c2d9b47
+Revises:
+Create Date: 2026-10-17 09:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3a1f0c2d9b47'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'cdp_audit',
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('created', sa.DateTime, nullable=False),
+        sa.Column('package_id', sa.UnicodeText, nullable=False),
+        sa.Column('actor', sa.UnicodeText),
+        sa.Column('field', sa.UnicodeText),
+        sa.Column('old_value', sa.UnicodeText),
+        sa.Column('new_value', sa.UnicodeText),
+        sa.Column('collaborator_user_id', sa.UnicodeText),
+        sa.Column('capacity', sa.UnicodeText),
+        sa.Column('result', sa.UnicodeText),
+    )
+    op.create_index(
+        'idx_cdp_audit_package_created', 'cdp_audit',
+        ['package_id', 'created'])
+    op.create_index('idx_cdp_audit_created', 'cdp_audit', ['created'])
+
+
+def downgrade():
+    op.drop_table('cdp_audit')
@@ -0,0 +1,33 @@
+"""Create cdp_revocation
+
+Revision ID: 8c4e7d21f5a3
+Revises: 3a1f0c2d9b47
+Create Date: 2026-10-17 10:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8c4e7d21f5a3'
+down_revision = '3a1f0c2d9b47'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'cdp_revocation',
+        sa.Column('package_id', sa.UnicodeText, nullable=False),
+        sa.Column('user_id', sa.UnicodeText, nullable=False),
+        sa.Column('revoked', sa.DateTime, nullable=False),
+        sa.PrimaryKeyConstraint('package_id', 'user_id'),
+    )
+    op.create_index(
+        'idx_cdp_revocation_user_revoked', 'cdp_revocation',
+        ['user_id', 'revoked'])
+
+
+def downgrade():
+    op.drop_table('cdp_revocation')
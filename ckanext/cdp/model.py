@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+"""
+ตารางของ extension อยู่ใน metadata ของตัวเอง (ไม่ใช่ของ CKAN core) และสร้าง
+ด้วย migration ใน migration/cdp::
+
+    ckan -c /etc/ckan/default/ckan.ini db upgrade -p cdp
+"""
+import datetime
+
+from sqlalchemy import (
+    Column, DateTime, Index, Integer, MetaData, PrimaryKeyConstraint, Table,
+    UnicodeText,
+)
+
+metadata = MetaData()
+
+cdp_audit_table = Table(
+    'cdp_audit', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('created', DateTime, nullable=False,
+           default=datetime.datetime.utcnow),
+    Column('package_id', UnicodeText, nullable=False),
+    Column('actor', UnicodeText),
+    Column('field', UnicodeText),
+    Column('old_value', UnicodeText),
+    Column('new_value', UnicodeText),
+    Column('collaborator_user_id', UnicodeText),
+    Column('capacity', UnicodeText),
+    Column('result', UnicodeText),
+    Index('idx_cdp_audit_package_created', 'package_id', 'created'),
+    Index('idx_cdp_audit_created', 'created'),
+)
+
+# เวลาล่าสุดที่ user ถูกถอดออกจาก collaborator ของ dataset (แถว package_member
+# ถูกลบจึงไม่เหลือเวลาให้ change feed อ่าน) เขียนใน transaction เดียวกับการลบ
+cdp_revocation_table = Table(
+    'cdp_revocation', metadata,
+    Column('package_id', UnicodeText, nullable=False),
+    Column('user_id', UnicodeText, nullable=False),
+    Column('revoked', DateTime, nullable=False),
+    PrimaryKeyConstraint('package_id', 'user_id'),
+    Index('idx_cdp_revocation_user_revoked', 'user_id', 'revoked'),
+)
@@ -3,86 +3,34 @@ import ckan.plugins as plugins
 import ckan.plugins.toolkit as toolkit
 from ckan import model # Import model เพื่อใช้หา User
 
-# Fix package_collaborator_create and package_collaborator_delete เพื่อให้คนที่สร้าง dataset สามารถเพิ่ม collaborator ได้
-import ckan.lib.dictization.model_dictize as model_dictize
-import ckan.logic as logic
-import datetime
 import logging
-log = logging.getLogger(__name__)
-ValidationError = logic.ValidationError
-NotFound = logic.NotFound
-_get_or_bust = logic.get_or_bust
-
-def package_collaborator_create_any(context, data_dict):
-    '''Allow anyone to make a user a collaborator in a dataset.
-    '''
-
-    model = context['model']
-
-    package_id, user_id, capacity = _get_or_bust(
-        data_dict,
-        ['id', 'user_id', 'capacity']
-    )
 
-    package = model.Package.get(package_id)
-    if not package:
-        raise NotFound('Dataset not found')
-
-    user = model.User.get(user_id)
-    if not user:
-        raise NotFound('User not found')
-
-    # Check if collaborator already exists
-    collaborator = model.Session.query(model.PackageMember). \
-        filter(model.PackageMember.package_id == package.id). \
-        filter(model.PackageMember.user_id == user.id).one_or_none()
-    if not collaborator:
-        collaborator = model.PackageMember(
-            package_id=package.id,
-            user_id=user.id)
-    collaborator.capacity = capacity
-    collaborator.modified = datetime.datetime.utcnow()
-    model.Session.add(collaborator)
-    model.repo.commit()
-
-    log.info('User {} added as collaborator in package {} ({})'.format(
-        user.name, package.id, capacity))
+from ckanext.cdp import (
+    audit, batch, cdp_schema, changes, cli, collaborator, jobs, metrics,
+    principal, rules, spatial, validators, views,
+)
+from ckanext.cdp.logic import action, auth
+# Fix package_collaborator_create and package_collaborator_delete เพื่อให้คนที่สร้าง dataset สามารถเพิ่ม collaborator ได้
+# (ย้ายไปอยู่ใน logic/action.py และเปิดใช้ผ่าน IActions แล้ว)
+from ckanext.cdp.logic.action import (
+    package_collaborator_create_any,
+    package_collaborator_delete_any,
+)
 
-    return model_dictize.member_dictize(collaborator, context)
+log = logging.getLogger(__name__)
 
 
-def package_collaborator_delete_any(context, data_dict):
-    '''Allow anoy to remove a collaborator from a dataset.
+def _summarize(results):
     '''
+    รวมผลลัพธ์ของหลาย user เป็นค่าเดียวสำหรับ metrics
+    '''
+    changed = set(results) - {collaborator.NOOP}
+    if not changed:
+        return collaborator.NOOP
+    if len(changed) == 1:
+        return changed.pop()
+    return collaborator.UPDATED
 
-    model = context['model']
-
-    package_id, user_id = _get_or_bust(
-        data_dict,
-        ['id', 'user_id']
-    )
-
-    package = model.Package.get(package_id)
-    if not package:
-        raise NotFound('Package not found')
-
-    user = model.User.get(user_id)
-    if not user:
-        raise NotFound('User not found')
-
-    collaborator = model.Session.query(model.PackageMember).\
-        filter(model.PackageMember.package_id == package.id).\
-        filter(model.PackageMember.user_id == user.id).one_or_none()
-    if not collaborator:
-        raise NotFound(
-            'User {} is not a collaborator on this package'.format(user_id))
-
-    model.Session.delete(collaborator)
-    model.repo.commit()
-
-    log.info('User {} removed as collaborator from package {}'.format(
-        user_id, package.id))
-    
 
 class CdpPlugin(plugins.SingletonPlugin):
     plugins.implements(plugins.IConfigurer)
@@ -90,6 +38,17 @@ class CdpPlugin(plugins.SingletonPlugin):
     plugins.implements(plugins.IDatasetForm)
     # เพิ่ม implements IPackageController
     plugins.implements(plugins.IPackageController, inherit=True)
+    # เพิ่ม implements IClick สำหรับคำสั่ง `ckan cdp ...`
+    plugins.implements(plugins.IClick)
+    # เพิ่ม implements IActions / IAuthFunctions สำหรับ action จัดการ collaborator
+    plugins.implements(plugins.IActions)
+    plugins.implements(plugins.IAuthFunctions)
+    # เพิ่ม implements IBlueprint สำหรับ endpoint ของ CDP (เช่น change feed)
+    plugins.implements(plugins.IBlueprint)
+    # เพิ่ม implements ITemplateHelpers สำหรับ helper ของฟิลด์แบบ choice
+    plugins.implements(plugins.ITemplateHelpers)
+    # เพิ่ม implements IValidators สำหรับ validator ที่อ้างถึงใน schema
+    plugins.implements(plugins.IValidators)
 
     # IConfigurer: method นี้ใช้สำหรับเพิ่ม template, public directory และ resource ที่จำเป็น
     def update_config(self, config_):
@@ -100,7 +59,18 @@ class CdpPlugin(plugins.SingletonPlugin):
         # เพิ่มบรรทัดนี้เพื่อเปิดใช้งาน Collaborators
         config_['ckan.auth.allow_dataset_collaborators'] = 'true'
         # ตั้งค่าให้ Scheming ใช้ dataset schema ใหม่ที่ merge แล้ว
-        config_['scheming.dataset_schemas'] = 'ckanext.cdp:ckan_dataset_cdp.json'
+        # (merge จาก thai_gdc ตอนโหลด plugin และ cache ไว้บน disk ตาม hash)
+        config_['scheming.dataset_schemas'] = cdp_schema.scheming_schema_url()
+
+        # เริ่มนับ SQL statement และตั้งค่า statsd (ถ้ามี)
+        metrics.configure(config_)
+        # compile กฎความยินยอม (ดู rules.py) แล้ว reconcile เฉพาะเมื่อ field
+        # ที่กฎอ้างถึงเปลี่ยน และอ่าน config ของ audit
+        ruleset = rules.configure(config_)
+        changes.unsubscribe(self._on_rule_change)
+        for field in ruleset.fields:
+            changes.subscribe(field, self._on_rule_change)
+        audit.configure(config_)
 
     # IDatasetForm implementation helper function
     def _modify_package_schema(self, schema):
@@ -120,6 +90,32 @@ class CdpPlugin(plugins.SingletonPlugin):
         })
         return schema
 
+    # IClick: คืนคำสั่ง CLI ของ extension
+    def get_commands(self):
+        return cli.get_commands()
+
+    # IActions
+    def get_actions(self):
+        return action.get_actions()
+
+    # IAuthFunctions
+    def get_auth_functions(self):
+        return auth.get_auth_functions()
+
+    # IBlueprint
+    def get_blueprint(self):
+        return views.get_blueprints()
+
+    # ITemplateHelpers
+    def get_helpers(self):
+        return {
+            'cdp_choice_label': cdp_schema.choice_label,
+        }
+
+    # IValidators
+    def get_validators(self):
+        return validators.get_validators()
+
     # --- Implement methods ของ IDatasetForm ---
     # เราต้อง override method เหล่านี้เพื่อเรียก _modify_package_schema
     # และเพื่อให้แน่ใจว่า scheming ใช้ schema ที่ถูกต้อง
@@ -189,30 +185,8 @@ class CdpPlugin(plugins.SingletonPlugin):
         หากฟิลด์ 'data_cdp' ถูกตั้งเป็น 'yes' จะเพิ่ม user 'cdp_user'
         เป็น editor collaborator ให้กับ dataset นั้น
         """
-        # ดึงข้อมูล user object จากชื่อ 'cdp_user' และดึง package ID จาก dictionary ผลลัพธ์ของการสร้าง dataset
-        user = model.User.get("cdp_user")
-        user_id = user.id
-        package_id = res_dict.get('id')
-
-        # เตรียมข้อมูล dictionary สำหรับใช้กับ action package_collaborator_create_any
-        data_create = {
-            'id': package_id,      # ID ของ dataset ที่จะเพิ่ม collaborator
-            'user_id': user_id,    # ID ของ user ที่จะเพิ่มเป็น collaborator
-            'capacity': 'editor'   # ระดับสิทธิ์ของ collaborator
-        }
-        # เรียก action เพื่อเพิ่ม collaborator เข้าไปใน dataset; ผลลัพธ์จะถูกเก็บใน result_create
-        result_create = package_collaborator_create_any(context.copy(), data_create)
-
-        # ตรวจสอบว่าค่า res_dict.get('data_cdp') ไม่ใช่ 'yes'
-        if res_dict.get('data_cdp') != 'yes':
-            # เตรียมข้อมูล dictionary สำหรับใช้กับ action package_collaborator_delete_any
-            data_delete = {
-                'id': package_id,      # ID ของ dataset ที่จะลบ collaborator ออก
-                'user_id': user_id     # ID ของ user ที่จะถูกลบออกจากการเป็น collaborator
-            }
-            # เรียก action เพื่อลบ collaborator ออกจาก dataset; ผลลัพธ์จะถูกเก็บใน result_delete
-            result_delete = package_collaborator_delete_any(context.copy(), data_delete)
-
+        metrics.call('after_create', self._after_save, context, res_dict, True)
+        spatial.index_package(res_dict)
         # คืนค่า dictionary ผลลัพธ์ของการสร้าง dataset กลับไป
         return res_dict
 
@@ -221,29 +195,109 @@ class CdpPlugin(plugins.SingletonPlugin):
         Callback ที่ถูกเรียกหลังจากแก้ไข dataset
         ตรวจสอบฟิลด์ 'data_cdp' แล้วเพิ่มหรือลบ user 'cdp_user' ตามค่าที่เลือก
         """
-        # ดึงข้อมูล user object จากชื่อ 'cdp_user' และดึง package ID จาก dictionary ผลลัพธ์ของการสร้าง dataset
-        user = model.User.get("cdp_user")
-        user_id = user.id
+        metrics.call('after_update', self._after_save, context, pkg_dict, False)
+        spatial.index_package(pkg_dict)
+        # คืนค่า dictionary ข้อมูล dataset ที่อัปเดตแล้วกลับไป
+        return pkg_dict
+
+    def after_delete(self, context, pkg_dict):
+        """
+        ลบ dataset ออกจาก index กรอบพื้นที่ (ถ้าสร้างไว้แล้ว)
+        """
+        spatial.unindex_package(pkg_dict['id'])
+        return pkg_dict
+
+    def before_index(self, pkg_dict):
+        """
+        เพิ่มฟิลด์สำหรับ Solr เพื่อให้ค้นหา/ทำ facet dataset ที่ยินยอมส่งให้ CDP ได้
+          - cdp_consent: ค่า data_cdp ('yes' หรือ 'no')
+          - cdp_collaborator: 'true' ถ้าตามกฎ CDP user ควรเป็น collaborator ของ
+            dataset (สถานะที่กฎต้องการ ไม่ได้อ่านจาก package_member)
+        """
+        return metrics.call('before_index', self._index_fields, pkg_dict)
+
+    def _index_fields(self, pkg_dict):
+        """
+        คำนวณจากค่าใน pkg_dict ตามกฎ (rules.py) โดยไม่ query เพราะ before_index
+        ทำงานทุกครั้งที่บันทึก cdp_collaborator จึงเป็นสถานะที่กฎต้องการ ซึ่ง
+        hook, batch, background job และ ``ckan cdp reconcile`` ทำให้แถว
+        package_member ตรงกัน ค่านี้ไม่เปลี่ยนตามแถวที่ถูกแก้ในฐานข้อมูลโดยตรง
+        หรือผ่าน action package_collaborator_*
+        """
+        consent = pkg_dict.get('data_cdp') or pkg_dict.get('extras_data_cdp')
+        pkg_dict['cdp_consent'] = 'yes' if consent == 'yes' else 'no'
+        desired = rules.get_ruleset().desired(
+            lambda field: pkg_dict.get(field) or
+            pkg_dict.get('extras_' + field))
+        pkg_dict['cdp_collaborator'] = 'true' \
+            if desired.get(principal.get_user_name()) else 'false'
+        return pkg_dict
+
+    def _after_save(self, context, pkg_dict, created):
+        """
+        ส่งต่อให้ handler ของ field ที่เปลี่ยน (ดู changes.py) ถ้า field ที่กฎ
+        อ้างถึงไม่เปลี่ยนก็ไม่มีการ query หรือเขียนเพิ่มเลย
+        """
+        results = changes.dispatch(context, pkg_dict, created)
+        return results[0] if len(results) == 1 else collaborator.NOOP
+
+    def _on_rule_change(self, context, pkg_dict, changed):
+        """
+        handler ของ field ที่กฎอ้างถึง: reconcile user ของทุกกฎในครั้งเดียว
+        แล้วบันทึก audit ของ field ที่เปลี่ยน
+        """
         package_id = pkg_dict.get('id')
+        ruleset = rules.get_ruleset()
+        # ถ้า reconcile ล้มเหลว exception ทำให้การบันทึกทั้งหมด rollback การบันทึก
+        # ครั้งถัดไปจึงเห็นการเปลี่ยนของ field อีกครั้งเอง
+        desired, results = self._reconcile_rules(context, pkg_dict, ruleset)
+
+        user_ids = ruleset.user_ids()
+        for name in ruleset.users:
+            result = results[name]
+            for field in ruleset.fields_for(name):
+                if field not in changed:
+                    continue
+                old_value, new_value = changed[field]
+                if old_value != new_value or result in (
+                        collaborator.ADDED, collaborator.UPDATED,
+                        collaborator.REMOVED):
+                    audit.record(
+                        package_id,
+                        actor=context.get('user'),
+                        field=field,
+                        old_value=old_value,
+                        new_value=new_value,
+                        collaborator_user_id=user_ids[name],
+                        capacity=desired[name],
+                        result=result)
+        return _summarize(results.values())
+
+    def _reconcile_rules(self, context, pkg_dict, ruleset):
+        """
+        คำนวณ capacity ที่ต้องการของ user ทุกกฎจากค่าของ dataset ในรอบเดียว
+        แล้วให้ reconciliation engine อ่านและเขียนแถวของทุก user พร้อมกัน
+        คืน (ชื่อ user -> capacity, ชื่อ user -> ผลลัพธ์)
 
-        # เตรียมข้อมูล dictionary สำหรับใช้กับ action package_collaborator_create_any
-        data_create = {
-            'id': package_id,      # ID ของ dataset ที่จะเพิ่ม collaborator
-            'user_id': user_id,    # ID ของ user ที่จะเพิ่มเป็น collaborator
-            'capacity': 'editor'   # ระดับสิทธิ์ของ collaborator
-        }
-        # เรียก action เพื่อเพิ่ม collaborator เข้าไปใน dataset; ผลลัพธ์จะถูกเก็บใน result_create
-        result_create = package_collaborator_create_any(context, data_create)
-
-        # ตรวจสอบว่าค่า pkg_dict.get('data_cdp') ไม่ใช่ 'yes'
-        if pkg_dict.get('data_cdp') != 'yes':
-            # เตรียมข้อมูล dictionary สำหรับใช้กับ action package_collaborator_delete_any
-            data_delete = {
-                'id': package_id,      # ID ของ dataset ที่จะลบ collaborator ออก
-                'user_id': user_id     # ID ของ user ที่จะถูกลบออกจากการเป็น collaborator
-            }
-            # เรียก action เพื่อลบ collaborator ออกจาก dataset; ผลลัพธ์จะถูกเก็บใน result_delete
-            result_delete = package_collaborator_delete_any(context, data_delete)
+        ถ้าอยู่ใน batch (ดู batch.py) จะจด id ไว้ reconcile ตอนปิด batch
+        ถ้าเปิด ckanext.cdp.async จะส่งงานเข้า job queue หลัง commit แทนการเขียน
+        ใน request
+        """
+        desired = ruleset.desired(
+            lambda field: changes.field_value(pkg_dict, field))
+        current_batch = batch.current_batch(context)
+        if current_batch is not None:
+            current_batch.add(pkg_dict.get('id'))
+            return desired, dict.fromkeys(desired, collaborator.DEFERRED)
+        if jobs.is_async():
+            jobs.enqueue_after_commit(pkg_dict.get('id'))
+            return desired, dict.fromkeys(desired, collaborator.DEFERRED)
+        # id ของ user ถูก cache ไว้ต่อ process (ดู principal.py)
+        user_ids = ruleset.user_ids()
+        results = collaborator.reconcile_package(
+            context, pkg_dict.get('id'),
+            dict((user_ids[name], capacity)
+                 for name, capacity in desired.items()))
+        return desired, dict((name, results[user_ids[name]])
+                             for name in desired)
 
-        # คืนค่า dictionary ข้อมูล dataset ที่อัปเดตแล้วกลับไป
-        return pkg_dict
\ No newline at end of file
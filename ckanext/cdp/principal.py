@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""
+Principal resolution สำหรับ CDP service user
+
+ชื่อ user อ่านจาก config ``ckanext.cdp.user`` (ค่าเริ่มต้น ``cdp_user``)
+และ id ที่ resolve ได้จะถูก cache ไว้ระดับ worker process เพื่อไม่ต้อง
+query ตาราง user ทุกครั้งที่บันทึก dataset
+
+cache จะถูกล้างเมื่อ:
+  - มีการเพิ่ม/แก้ไข/ลบ User ที่มีชื่อหรือ id ตรงกับที่ cache ไว้ใน session นี้
+    (ผ่าน SQLAlchemy ``after_flush``)
+  - ครบอายุ ``ckanext.cdp.user_cache_ttl`` วินาที (ค่าเริ่มต้น 300)
+    เพื่อรองรับการเปลี่ยนแปลงจาก process อื่น
+"""
+import logging
+import threading
+import time
+
+from sqlalchemy import event
+
+import ckan.logic as logic
+import ckan.plugins.toolkit as toolkit
+from ckan import model
+
+log = logging.getLogger(__name__)
+
+DEFAULT_USER = 'cdp_user'
+DEFAULT_TTL = 300
+
+_lock = threading.Lock()
+# name -> (user_id, expires_at)
+_cache = {}
+_listening = False
+
+
+def get_user_name():
+    """
+    คืนชื่อ CDP service user จาก config
+    """
+    return toolkit.config.get('ckanext.cdp.user', DEFAULT_USER)
+
+
+def _ttl():
+    return toolkit.asint(
+        toolkit.config.get('ckanext.cdp.user_cache_ttl', DEFAULT_TTL))
+
+
+def get_user_id(name=None):
+    """
+    คืน id ของ CDP service user โดยใช้ค่าใน cache ถ้ายังไม่หมดอายุ
+
+    ถ้าไม่พบ user จะ raise NotFound พร้อมข้อความที่บอกชัดเจนว่าต้องสร้าง user
+    ใด แทน AttributeError จากการเข้าถึง None.id
+    """
+    name = name or get_user_name()
+    entry = _cache.get(name)
+    now = time.time()
+    if entry is not None and entry[1] > now:
+        return entry[0]
+
+    user = model.User.get(name)
+    if user is None:
+        raise logic.NotFound(
+            'CDP user "{}" not found; create it or set '
+            'ckanext.cdp.user to an existing user name'.format(name))
+
+    _listen()
+    with _lock:
+        _cache[name] = (user.id, now + _ttl())
+    return user.id
+
+
+def get_user_ids(names):
+    """
+    คืน dict ชื่อ -> id ของ user หลายคน (เช่น user ของทุกกฎใน rules.py)
+
+    ชื่อที่ไม่อยู่ใน cache จะถูก resolve ด้วย query เดียว (``name IN (...)``)
+    ถ้ามีชื่อที่ไม่พบจะ raise NotFound เหมือน get_user_id
+    """
+    now = time.time()
+    ids = {}
+    missing = []
+    for name in names:
+        entry = _cache.get(name)
+        if entry is not None and entry[1] > now:
+            ids[name] = entry[0]
+        else:
+            missing.append(name)
+    if not missing:
+        return ids
+
+    found = dict(model.Session.query(model.User.name, model.User.id).
+                 filter(model.User.name.in_(missing)))
+    not_found = [name for name in missing if name not in found]
+    if not_found:
+        raise logic.NotFound(
+            'CDP users not found: {}; create them or fix the user names '
+            'in the ckanext.cdp rules'.format(', '.join(not_found)))
+
+    _listen()
+    expires = now + _ttl()
+    with _lock:
+        for name, user_id in found.items():
+            _cache[name] = (user_id, expires)
+    ids.update(found)
+    return ids
+
+
+def invalidate(name=None):
+    """
+    ล้าง cache ของ user ที่ระบุ หรือทั้งหมดถ้าไม่ระบุชื่อ
+    """
+    with _lock:
+        if name is None:
+            _cache.clear()
+        else:
+            _cache.pop(name, None)
+
+
+def _listen():
+    global _listening
+    if _listening:
+        return
+    with _lock:
+        if not _listening:
+            event.listen(model.Session, 'after_flush', _after_flush)
+            _listening = True
+
+
+def _after_flush(session, flush_context):
+    if not _cache:
+        return
+    for obj in session.new | session.dirty | session.deleted:
+        if not isinstance(obj, model.User):
+            continue
+        cached_ids = set(entry[0] for entry in _cache.values())
+        if obj.name in _cache or obj.id in cached_ids:
+            log.debug('Invalidating CDP principal cache for %s', obj.name)
+            invalidate()
+            return
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""
+กฎความยินยอมแบบหลายโครงการ
+
+แต่ละกฎมีรูปแบบ ``field == value -> user (capacity)`` เช่นค่าเริ่มต้น::
+
+    [{"field": "data_cdp", "value": "yes",
+      "user": "cdp_user", "capacity": "editor"}]
+
+กำหนดได้ใน ckan.ini ด้วย ``ckanext.cdp.rules`` (JSON) หรือ
+``ckanext.cdp.rules_file`` (path ของไฟล์ JSON) ถ้าไม่กำหนดจะใช้กฎเดียวข้างบน
+โดยชื่อ user มาจาก ``ckanext.cdp.user``
+
+กฎถูก compile ตอน update_config เป็นตาราง field -> value -> กฎ ทำให้การ
+ประเมินต่อ dataset เป็นการ lookup ครั้งเดียวต่อ field ถ้า user หนึ่งตรงกับหลายกฎ
+จะใช้ capacity ของกฎที่อยู่ก่อน
+"""
+import io
+import json
+import logging
+
+from ckanext.cdp import principal
+
+log = logging.getLogger(__name__)
+
+CAPACITIES = ('editor', 'member')
+RULE_KEYS = ('field', 'value', 'user', 'capacity')
+
+
+class Rule(object):
+    __slots__ = ('index', 'field', 'value', 'user', 'capacity')
+
+    def __init__(self, index, field, value, user, capacity):
+        self.index = index
+        self.field = field
+        self.value = value
+        self.user = user
+        self.capacity = capacity
+
+    def __repr__(self):
+        return 'Rule({!r} == {!r} -> {} ({}))'.format(
+            self.field, self.value, self.user, self.capacity)
+
+
+class RuleSet(object):
+    """
+    กฎที่ compile แล้ว
+
+    ``fields`` คือ field ที่กฎอ้างถึง ``users`` คือชื่อ user ทั้งหมด (ตามลำดับ)
+    และ ``predicates(user)`` คืน list ของ (field, value, capacity) ของ user นั้น
+    ตามลำดับความสำคัญ สำหรับใช้กับคำสั่ง SQL แบบ set-based
+    """
+
+    def __init__(self, rules):
+        self.rules = tuple(rules)
+        self.fields = tuple(sorted(set(rule.field for rule in self.rules)))
+        users = []
+        for rule in self.rules:
+            if rule.user not in users:
+                users.append(rule.user)
+        self.users = tuple(users)
+        self._table = {}
+        for rule in self.rules:
+            self._table.setdefault(rule.field, {}).setdefault(
+                rule.value, []).append(rule)
+
+    def desired(self, get_value):
+        """
+        คืน dict ชื่อ user -> capacity ที่ต้องการ (None = ไม่ควรเป็น collaborator)
+        get_value(field) คืนค่าของ field ของ dataset
+        """
+        desired = dict.fromkeys(self.users)
+        matched = []
+        for field in self.fields:
+            matched.extend(self._table[field].get(get_value(field), ()))
+        for rule in sorted(matched, key=lambda rule: rule.index):
+            if desired[rule.user] is None:
+                desired[rule.user] = rule.capacity
+        return desired
+
+    def user_ids(self):
+        """
+        คืน dict ชื่อ -> id ของ user ทุกกฎ (resolve ด้วย query เดียว ดู principal)
+        """
+        return principal.get_user_ids(self.users)
+
+    def fields_for(self, user):
+        return [rule.field for rule in self.rules if rule.user == user]
+
+    def predicates(self, user):
+        return [(rule.field, rule.value, rule.capacity)
+                for rule in self.rules if rule.user == user]
+
+
+def compile_rules(entries):
+    """
+    ตรวจสอบและ compile list ของ dict กฎเป็น RuleSet
+    raise ValueError ถ้ากฎไม่ถูกต้อง เพื่อให้ CKAN หยุดตั้งแต่ตอนเริ่ม
+    """
+    if not isinstance(entries, list) or not entries:
+        raise ValueError('ckanext.cdp rules must be a non-empty JSON list')
+    rules = []
+    for index, entry in enumerate(entries):
+        if not isinstance(entry, dict) or \
+                not all(entry.get(key) for key in RULE_KEYS):
+            raise ValueError(
+                'ckanext.cdp rule {} must have {}'.format(
+                    index, ', '.join(RULE_KEYS)))
+        if entry['capacity'] not in CAPACITIES:
+            raise ValueError(
+                'ckanext.cdp rule {}: capacity must be one of {}'.format(
+                    index, CAPACITIES))
+        rules.append(Rule(index, entry['field'], entry['value'],
+                          entry['user'], entry['capacity']))
+    return RuleSet(rules)
+
+
+def _default_entries(config):
+    return [{
+        'field': 'data_cdp',
+        'value': 'yes',
+        'user': config.get('ckanext.cdp.user', principal.DEFAULT_USER),
+        'capacity': 'editor',
+    }]
+
+
+def load_entries(config):
+    """
+    อ่านกฎจาก config ``ckanext.cdp.rules`` หรือ ``ckanext.cdp.rules_file``
+    """
+    inline = config.get('ckanext.cdp.rules')
+    path = config.get('ckanext.cdp.rules_file')
+    if inline:
+        return json.loads(inline)
+    if path:
+        with io.open(path, encoding='utf-8') as f:
+            return json.load(f)
+    return _default_entries(config)
+
+
+_ruleset = None
+
+
+def configure(config):
+    """
+    compile กฎจาก config (เรียกจาก update_config)
+    """
+    global _ruleset
+    _ruleset = compile_rules(load_entries(config))
+    log.debug('CDP rules: %r', _ruleset.rules)
+    return _ruleset
+
+
+def get_ruleset():
+    """
+    คืน RuleSet ที่ compile แล้ว (ใช้กฎเริ่มต้นถ้ายังไม่ได้ configure)
+    """
+    if _ruleset is None:
+        import ckan.plugins.toolkit as toolkit
+        return configure(toolkit.config)
+    return _ruleset
@@ -0,0 +1,306 @@
+# -*- coding: utf-8 -*-
+"""
+Index กรอบพื้นที่ (bounding box) ของ dataset สำหรับ cdp_bbox_search
+
+ค่าพิกัดมาจาก extras ``west_bound_longitude``, ``east_bound_longitude``,
+``north_bound_longitude`` และ ``south_bound_longitude`` ของ schema (ชื่อ field
+ของทิศเหนือ/ใต้เป็น longitude ตาม thai_gdc แต่ค่าจริงเป็น latitude) ซึ่ง
+validator ใน validators.py แปลงเป็นตัวเลขไว้ตั้งแต่ตอนบันทึก
+
+index เป็น STR-tree (Sort-Tile-Recursive) แบบ packed ที่สร้างครั้งแรกเมื่อมีการ
+ค้นหา (lazy) จากตาราง package_extra การแก้ไขหลังจากนั้นมาจาก hook ของ plugin
+(update/remove) โดยเก็บใน buffer เล็กๆ แยกจาก tree และจด id ที่ถูกแทนที่ไว้
+เมื่อ buffer ใหญ่เกิน sqrt ของจำนวน dataset จึง pack tree ใหม่ การค้นหาจึงเป็น
+O(log n + k) บวกกับการวน buffer ขนาด O(sqrt n) การแก้ไขจาก hook ถูกพักไว้จน
+การบันทึก commit (ดู transaction.py) การบันทึกที่ rollback จึงไม่เปลี่ยน index
+
+index อยู่ใน memory ของแต่ละ worker process การแก้ไขจาก process อื่นจะเห็น
+เมื่อ index ถูกสร้างใหม่ตาม ``ckanext.cdp.bbox_index_ttl`` (วินาที ค่าเริ่มต้น 300)
+"""
+import logging
+import math
+import threading
+import time
+
+from sqlalchemy import and_, select
+
+import ckan.plugins.toolkit as toolkit
+from ckan import model
+
+from ckanext.cdp import changes, transaction
+
+log = logging.getLogger(__name__)
+
+# ลำดับของค่าในกรอบพื้นที่: (west, south, east, north)
+BBOX_FIELDS = (
+    'west_bound_longitude',
+    'south_bound_longitude',
+    'east_bound_longitude',
+    'north_bound_longitude',
+)
+RELATIONS = ('intersects', 'contains', 'within')
+NODE_CAPACITY = 16
+DEFAULT_TTL = 300
+# ชื่อของรายการที่พักไว้ใน transaction (ดู transaction.py)
+PENDING_NAME = 'cdp_bbox'
+
+
+def parse_bbox(get_value):
+    """
+    คืนกรอบพื้นที่ (west, south, east, north) เป็น float จาก get_value(field)
+    หรือ None ถ้าค่าไม่ครบ ไม่ใช่ตัวเลข หรือกรอบกลับด้าน (เช่นข้ามเส้น 180 องศา)
+    """
+    try:
+        bbox = tuple(float(get_value(field)) for field in BBOX_FIELDS)
+    except (TypeError, ValueError):
+        return None
+    west, south, east, north = bbox
+    if west > east or south > north:
+        return None
+    return bbox
+
+
+def _intersects(a, b):
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+
+def _contains(outer, inner):
+    return outer[0] <= inner[0] and outer[1] <= inner[1] and \
+        outer[2] >= inner[2] and outer[3] >= inner[3]
+
+
+# relation -> match(กรอบของ dataset, กรอบที่ค้นหา)
+_MATCH = {
+    'intersects': _intersects,
+    'contains': _contains,
+    'within': lambda box, bbox: _contains(bbox, box),
+}
+
+
+def _union(boxes):
+    return (min(b[0] for b in boxes), min(b[1] for b in boxes),
+            max(b[2] for b in boxes), max(b[3] for b in boxes))
+
+
+class STRTree(object):
+    """
+    R-tree แบบ packed ที่สร้างด้วยอัลกอริทึม STR จาก list ของ (bbox, key)
+
+    เก็บแต่ละระดับเป็น list ของ (bbox, start, end) ที่ชี้ช่วงของระดับถัดลงไป
+    ระดับล่างสุดคือ entries เอง tree สร้างแล้วแก้ไขไม่ได้
+    """
+
+    def __init__(self, entries, capacity=NODE_CAPACITY):
+        self.capacity = capacity
+        self.entries = self._pack(list(entries))
+        self.levels = []
+        boxes = [bbox for bbox, _ in self.entries]
+        while len(boxes) > 1:
+            nodes = [(_union(boxes[start:start + capacity]), start,
+                      min(start + capacity, len(boxes)))
+                     for start in range(0, len(boxes), capacity)]
+            # โหนดระดับบนจับกลุ่มตามลำดับที่ pack ไว้ ซึ่งเรียงตาม slab อยู่แล้ว
+            self.levels.append(nodes)
+            boxes = [bbox for bbox, _, _ in nodes]
+        # levels[0] คือ root
+        self.levels.reverse()
+
+    def _pack(self, entries):
+        """
+        เรียง entries ตาม STR: แบ่งตามแกน x เป็น slab แล้วเรียงตามแกน y ใน slab
+        ให้ leaf ที่อยู่ติดกันมีพื้นที่ใกล้กัน
+        """
+        if not entries:
+            return entries
+        leaves = int(math.ceil(len(entries) / float(self.capacity)))
+        slabs = int(math.ceil(math.sqrt(leaves)))
+        slab_size = slabs * self.capacity
+        entries.sort(key=lambda entry: entry[0][0] + entry[0][2])
+        packed = []
+        for start in range(0, len(entries), slab_size):
+            slab = entries[start:start + slab_size]
+            slab.sort(key=lambda entry: entry[0][1] + entry[0][3])
+            packed.extend(slab)
+        return packed
+
+    def __len__(self):
+        return len(self.entries)
+
+    def query(self, bbox, relation='intersects'):
+        """
+        วนคืน key ของ entry ที่มีความสัมพันธ์ relation กับ bbox
+          - intersects: กรอบของ entry ซ้อนทับกับ bbox
+          - contains: กรอบของ entry ครอบ bbox ทั้งหมด (เช่นค้นด้วยจุด)
+          - within: กรอบของ entry อยู่ภายใน bbox ทั้งหมด
+        """
+        if not self.entries:
+            return
+        match = _MATCH[relation]
+        # โหนดที่กรอบไม่ซ้อนทับ bbox ไม่มีทางมี entry ที่ตรงเงื่อนไข สำหรับ
+        # contains ต้องครอบ bbox ทั้งหมดด้วย เพราะกรอบของโหนดครอบกรอบลูกทุกตัว
+        descend = _contains if relation == 'contains' else _intersects
+
+        ranges = [(0, len(self.levels[0]))] if self.levels \
+            else [(0, len(self.entries))]
+        for level in self.levels:
+            ranges = [(node_start, node_end)
+                      for start, end in ranges
+                      for node_box, node_start, node_end in level[start:end]
+                      if descend(node_box, bbox)]
+        for start, end in ranges:
+            for box, key in self.entries[start:end]:
+                if match(box, bbox):
+                    yield key
+
+
+class BBoxIndex(object):
+    """
+    STR-tree ของ dataset ทั้งหมดพร้อม buffer สำหรับการแก้ไขระหว่างรอ pack ใหม่
+
+    ``records`` เก็บ package_id -> (bbox, private) ล่าสุด ``_stale`` คือ id ที่
+    entry ใน tree ไม่ตรงกับ records แล้ว (ถูกแก้ไขหรือลบ) ``_delta`` คือ id ที่
+    ค่าล่าสุดอยู่นอก tree
+    """
+
+    def __init__(self, records):
+        self._lock = threading.Lock()
+        self.records = dict(records)
+        self._pack()
+
+    def _pack(self):
+        self.tree = STRTree(
+            (bbox, package_id)
+            for package_id, (bbox, _) in self.records.items())
+        self._stale = set()
+        self._delta = set()
+
+    def _delta_limit(self):
+        return max(64, int(math.sqrt(len(self.records))))
+
+    def update(self, package_id, bbox, private=False):
+        """
+        บันทึกกรอบพื้นที่ใหม่ของ dataset (bbox เป็น None = ไม่มีกรอบพื้นที่)
+        """
+        with self._lock:
+            current = self.records.get(package_id)
+            if current == (bbox, private) or current is bbox is None:
+                return
+            self._stale.add(package_id)
+            if bbox is None:
+                del self.records[package_id]
+                self._delta.discard(package_id)
+            else:
+                self.records[package_id] = (bbox, private)
+                self._delta.add(package_id)
+            if len(self._delta) + len(self._stale) > self._delta_limit():
+                self._pack()
+
+    def remove(self, package_id):
+        self.update(package_id, None)
+
+    def search(self, bbox, relation='intersects', include_private=False):
+        """
+        คืน list ของ (package_id, bbox) ที่ตรงเงื่อนไข เรียงตาม package_id
+        """
+        with self._lock:
+            records = self.records
+            match = _MATCH[relation]
+            found = set(key for key in self.tree.query(bbox, relation)
+                        if key not in self._stale)
+            found.update(key for key in self._delta
+                         if match(records[key][0], bbox))
+            results = [(key, records[key][0]) for key in sorted(found)
+                       if include_private or not records[key][1]]
+        return results
+
+
+def _load_records():
+    """
+    อ่านกรอบพื้นที่ของ dataset ที่ active ทั้งหมดด้วย query เดียว
+    """
+    package = model.package_table
+    extra = model.package_extra_table
+    query = select([package.c.id, package.c.private, extra.c.key,
+                    extra.c.value]).select_from(
+        package.join(extra, extra.c.package_id == package.c.id)).where(and_(
+            package.c.state == 'active',
+            extra.c.state == 'active',
+            extra.c.key.in_(BBOX_FIELDS)))
+    values = {}
+    private = {}
+    for row in model.Session.execute(query):
+        values.setdefault(row['id'], {})[row['key']] = row['value']
+        private[row['id']] = bool(row['private'])
+    records = {}
+    for package_id, fields in values.items():
+        bbox = parse_bbox(fields.get)
+        if bbox is not None:
+            records[package_id] = (bbox, private[package_id])
+    return records
+
+
+_index = None
+_built_at = 0
+_build_lock = threading.Lock()
+
+
+def _ttl():
+    return toolkit.asint(
+        toolkit.config.get('ckanext.cdp.bbox_index_ttl', DEFAULT_TTL))
+
+
+def get_index():
+    """
+    คืน index ของ process นี้ สร้างจากฐานข้อมูลเมื่อเรียกครั้งแรกหรือเมื่อหมดอายุ
+    """
+    global _index, _built_at
+    if _index is not None and time.time() - _built_at < _ttl():
+        return _index
+    with _build_lock:
+        if _index is None or time.time() - _built_at >= _ttl():
+            started = time.time()
+            _index = BBoxIndex(_load_records())
+            _built_at = time.time()
+            log.info('Built CDP bbox index of %d datasets in %.3fs',
+                     len(_index.records), _built_at - started)
+    return _index
+
+
+def index_package(pkg_dict):
+    """
+    ปรับ index ตาม dataset ที่เพิ่งบันทึก (เรียกจาก hook ของ plugin ซึ่งทำงาน
+    ก่อน commit) index เปลี่ยนเมื่อ transaction commit แล้วเท่านั้น
+    """
+    bbox = None
+    if pkg_dict.get('state', 'active') == 'active':
+        bbox = parse_bbox(lambda field: changes.field_value(pkg_dict, field))
+    _stage(pkg_dict['id'], bbox, bool(pkg_dict.get('private')))
+
+
+def unindex_package(package_id):
+    _stage(package_id, None, False)
+
+
+def _stage(package_id, bbox, private):
+    transaction.register(PENDING_NAME, _apply_committed)
+    transaction.stage(PENDING_NAME, (package_id, bbox, private))
+
+
+def _apply_committed(updates):
+    """
+    ใส่การแก้ไขที่ commit แล้วลง index ตามลำดับ ถ้ายังไม่มีใครค้นหา index ยัง
+    ไม่ถูกสร้างและไม่ต้องทำอะไร
+    """
+    index = _index
+    if index is None:
+        return
+    for package_id, bbox, private in updates:
+        index.update(package_id, bbox, private)
+
+
+def reset():
+    """
+    ทิ้ง index ของ process นี้ (สร้างใหม่เมื่อค้นหาครั้งถัดไป)
+    """
+    global _index
+    _index = None
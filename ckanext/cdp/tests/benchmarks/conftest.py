@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+"""
+The benchmarks import thousands of datasets and need pytest-benchmark, so
+a plain test run skips them. They run with ``--benchmark-only`` or when
+``CKANEXT_CDP_BENCH`` is set (e.g. together with ``--benchmark-disable``
+to only check the statement counts).
+"""
+import os
+
+import pytest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def _enabled(config):
+    return bool(os.environ.get('CKANEXT_CDP_BENCH')) or \
+        bool(config.getoption('benchmark_only', default=False))
+
+
+def pytest_collection_modifyitems(config, items):
+    if _enabled(config):
+        return
+    skip = pytest.mark.skip(
+        reason='run with --benchmark-only or set CKANEXT_CDP_BENCH')
+    for item in items:
+        if os.path.abspath(str(item.fspath)).startswith(HERE + os.sep):
+            item.add_marker(skip)
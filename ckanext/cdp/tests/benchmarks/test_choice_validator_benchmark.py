@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+Per-save validation time of every choice field of a fully populated
+dataset: the validators each field had before the merge against the same
+lists with scheming's choice validators swapped for the ones compiled in
+cdp_schema.choice_validators.
+
+Only scheming_choices and scheming_multiple_choice are replaced. Fields
+without one of them (most single selects, e.g. data_cdp or
+update_frequency_unit) run the same validators in both variants.
+
+Run with ``pytest --benchmark-only ckanext/cdp/tests/benchmarks``.
+"""
+import io
+import json
+
+import pkg_resources
+import pytest
+
+import ckan.lib.navl.dictization_functions as df
+from ckanext.scheming.validation import validators_from_string
+
+from ckanext.cdp import cdp_schema
+
+SCHEMA_PATH = pkg_resources.resource_filename(
+    'ckanext.cdp', 'ckan_dataset_cdp.json')
+# what scheming uses for a field without "validators"
+DEFAULT_VALIDATORS = 'ignore_missing unicode_safe'
+# moves the value into extras; not part of the choice check
+SKIPPED_VALIDATORS = ('convert_to_extras',)
+
+
+def _choice_fields():
+    """The bundled schema and its fields with choices, each with the
+    validators string it had before the merge.
+    """
+    with io.open(SCHEMA_PATH, encoding='utf-8') as f:
+        schema = json.load(f)
+    fields = []
+    for field in schema['dataset_fields'] + schema['resource_fields']:
+        if not field.get('choices'):
+            continue
+        scheming = dict(
+            (prefix + field['field_name'], token)
+            for token, prefix in cdp_schema.SCHEMING_CHOICE_VALIDATORS.items())
+        merged = field.get('validators', DEFAULT_VALIDATORS).split()
+        original = [scheming.get(token, token) for token in merged
+                    if token not in SKIPPED_VALIDATORS]
+        fields.append((field, ' '.join(original)))
+    return schema, fields
+
+
+def _generic_schema():
+    """The navl schema scheming builds from the pre-merge validators.
+    """
+    schema, fields = _choice_fields()
+    return dict(
+        (field['field_name'], validators_from_string(original, field, schema))
+        for field, original in fields)
+
+
+def _compiled_schema():
+    """The same validators with scheming's choice check swapped for the
+    compiled one, as the merged schema has them.
+    """
+    schema, fields = _choice_fields()
+    compiled = cdp_schema.choice_validators(SCHEMA_PATH)
+    navl = {}
+    for field, original in fields:
+        validators = validators_from_string(original, field, schema)
+        for i, token in enumerate(original.split()):
+            prefix = cdp_schema.SCHEMING_CHOICE_VALIDATORS.get(token)
+            if prefix:
+                validators[i] = compiled[prefix + field['field_name']]
+        navl[field['field_name']] = validators
+    return navl
+
+
+def _populated_dataset():
+    """Every choice field set: multiple choice fields to their last three
+    choices, the others to their last choice.
+    """
+    _, fields = _choice_fields()
+    data = {}
+    for field, original in fields:
+        values = [c['value'] for c in field['choices']]
+        if 'scheming_multiple_choice' in original.split():
+            data[field['field_name']] = values[-3:]
+        else:
+            data[field['field_name']] = values[-1]
+    return data
+
+
+@pytest.mark.parametrize('variant', ['generic', 'compiled'])
+def test_choice_validation_per_save(benchmark, variant):
+    navl = _generic_schema() if variant == 'generic' else _compiled_schema()
+    data = _populated_dataset()
+
+    converted, errors = benchmark(df.validate, data, navl, {})
+
+    assert errors == {}
+    assert json.loads(converted['data_language']) == \
+        data['data_language']
+    assert converted['data_cdp'] == data['data_cdp']
@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks and regression checks for the CDP write path.
+
+``package_create`` and ``package_update`` are driven through the loaded
+CdpPlugin against the test database configured in test.ini (SQLite or
+PostgreSQL). For every scenario the latency, the SQL statements and
+commits per operation and the statements run inside the CDP hooks
+(after_create, after_update and before_index) are recorded in the
+benchmark's ``extra_info`` and compared with ``write_path_baseline.json``:
+
+* statement and commit counts may not grow by more than
+  ``CKANEXT_CDP_BENCH_THRESHOLD`` (default 0.1, i.e. 10%)
+* the mean latency may not grow by more than
+  ``CKANEXT_CDP_BENCH_LATENCY_THRESHOLD`` (default 0.5); it is only
+  checked when the benchmark is not disabled and the baseline has it
+
+Scenarios without a baseline entry are only recorded. No baseline is
+committed yet, so the comparison is not active until one is recorded on the
+reference machine with::
+
+    CKANEXT_CDP_UPDATE_BASELINE=1 pytest --ckan-ini=test.ini \\
+        --benchmark-only ckanext/cdp/tests/benchmarks/test_write_path_benchmark.py
+
+The suite is skipped unless ``--benchmark-only`` is passed or
+``CKANEXT_CDP_BENCH`` is set (see conftest.py), and no CI job runs it, so
+regressions are only caught when someone runs it. The 10k dataset import
+only runs when ``CKANEXT_CDP_BENCH_FULL`` is set.
+"""
+import io
+import json
+import os
+
+import pytest
+from sqlalchemy import event
+
+from ckan import model
+from ckan.tests import helpers
+
+from ckanext.cdp import metrics
+from ckanext.cdp.batch import cdp_batch
+
+BASELINE_PATH = os.path.join(
+    os.path.dirname(__file__), 'write_path_baseline.json')
+THRESHOLD = float(os.environ.get('CKANEXT_CDP_BENCH_THRESHOLD', '0.1'))
+LATENCY_THRESHOLD = float(
+    os.environ.get('CKANEXT_CDP_BENCH_LATENCY_THRESHOLD', '0.5'))
+COUNTERS = ('queries', 'commits', 'hook_queries')
+HOOKS = ('after_create', 'after_update', 'before_index')
+ROUNDS = 20
+
+
+class WritePathCounter(object):
+    """Counts SQL statements, commits and statements run by the CDP hooks
+    while it is active.
+    """
+
+    def __init__(self):
+        self.commits = 0
+
+    def _on_commit(self, session):
+        self.commits += 1
+
+    def __enter__(self):
+        metrics.install()
+        event.listen(model.Session, 'after_commit', self._on_commit)
+        self._queries = metrics.query_count()
+        self._hooks = self._hook_queries()
+        self.commits = 0
+        return self
+
+    def __exit__(self, *exc_info):
+        event.remove(model.Session, 'after_commit', self._on_commit)
+        self.queries = metrics.query_count() - self._queries
+        self.hook_queries = self._hook_queries() - self._hooks
+        return False
+
+    @staticmethod
+    def _hook_queries():
+        return sum(metrics.snapshot(name)['queries'] for name in HOOKS)
+
+
+class Baseline(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.update = bool(os.environ.get('CKANEXT_CDP_UPDATE_BASELINE'))
+        self.recorded = {}
+        try:
+            with io.open(path, encoding='utf-8') as f:
+                self.stored = json.load(f)
+        except IOError:
+            self.stored = {}
+
+    def check(self, name, result):
+        """Record the result of a scenario and fail if it regressed.
+        """
+        self.recorded[name] = result
+        stored = self.stored.get(name)
+        if self.update or stored is None:
+            return
+        regressions = []
+        for key in COUNTERS:
+            limit = stored[key] * (1 + THRESHOLD)
+            if result[key] > stored[key] and result[key] > limit:
+                regressions.append('{}: {} > baseline {}'.format(
+                    key, result[key], stored[key]))
+        if result.get('seconds') and stored.get('seconds') and \
+                result['seconds'] > stored['seconds'] * (
+                    1 + LATENCY_THRESHOLD):
+            regressions.append('seconds: {:.6f} > baseline {:.6f}'.format(
+                result['seconds'], stored['seconds']))
+        assert not regressions, '{} regressed: {}'.format(
+            name, '; '.join(regressions))
+
+    def save(self):
+        if not self.update or not self.recorded:
+            return
+        self.stored.update(self.recorded)
+        with io.open(self.path, 'w', encoding='utf-8') as f:
+            f.write(json.dumps(self.stored, indent=2, sort_keys=True) + '\n')
+
+
+@pytest.fixture(scope='module')
+def baseline():
+    baseline = Baseline(BASELINE_PATH)
+    yield baseline
+    baseline.save()
+
+
+def _result(benchmark, counter, per_round=1):
+    """Counters per operation and the mean latency per operation, where a
+    benchmark round runs ``per_round`` operations.
+    """
+    stats = getattr(benchmark, 'stats', None)
+    # with --benchmark-disable the function runs only once
+    rounds = len(stats.stats.data) if stats is not None else 1
+    operations = float(rounds * per_round)
+    result = dict((key, round(getattr(counter, key) / operations, 2))
+                  for key in COUNTERS)
+    result['seconds'] = stats.stats.mean / per_round \
+        if stats is not None else None
+    benchmark.extra_info.update(result)
+    return result
+
+
+def _extras(consent):
+    return [{'key': 'data_cdp', 'value': consent}]
+
+
+@pytest.mark.usefixtures("clean_db", "cdp_user")
+def test_toggle_data_cdp(benchmark, baseline):
+    dataset = helpers.call_action(
+        'package_create', name='toggled', extras=_extras('no'))
+    values = iter(['yes', 'no'] * ROUNDS)
+
+    def toggle():
+        helpers.call_action(
+            'package_patch', id=dataset['id'], extras=_extras(next(values)))
+
+    with WritePathCounter() as counter:
+        benchmark.pedantic(toggle, rounds=ROUNDS, iterations=1)
+
+    baseline.check('toggle_data_cdp', _result(benchmark, counter))
+
+
+@pytest.mark.usefixtures("clean_db", "cdp_user")
+def test_unchanged_edit(benchmark, baseline):
+    dataset = helpers.call_action(
+        'package_create', name='unchanged', extras=_extras('yes'))
+
+    def update():
+        helpers.call_action('package_update', **dataset)
+
+    with WritePathCounter() as counter:
+        benchmark.pedantic(update, rounds=ROUNDS, iterations=1)
+
+    # the CDP hooks must not touch the database when data_cdp is unchanged
+    assert counter.hook_queries == 0
+    baseline.check('unchanged_edit', _result(benchmark, counter))
+
+
+@pytest.mark.usefixtures("clean_db", "cdp_user")
+@pytest.mark.parametrize('mode', ['hooks', 'batch'])
+@pytest.mark.parametrize('size', [
+    1000,
+    pytest.param(10000, marks=pytest.mark.skipif(
+        not os.environ.get('CKANEXT_CDP_BENCH_FULL'),
+        reason='set CKANEXT_CDP_BENCH_FULL to import 10k datasets')),
+])
+def test_bulk_import(benchmark, baseline, size, mode):
+    def bulk_import():
+        def create_all():
+            for i in range(size):
+                helpers.call_action(
+                    'package_create', name='bulk-{}'.format(i),
+                    extras=_extras('yes' if i % 2 else 'no'))
+        if mode == 'batch':
+            with cdp_batch():
+                create_all()
+        else:
+            create_all()
+
+    with WritePathCounter() as counter:
+        benchmark.pedantic(bulk_import, rounds=1, iterations=1)
+
+    assert model.Session.query(model.PackageMember).count() == size // 2
+    baseline.check('bulk_import_{}_{}'.format(mode, size),
+                   _result(benchmark, counter, size))
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from ckan.tests import factories
+
+from ckanext.cdp import principal
+
+
+@pytest.fixture
+def cdp_user():
+    """The service user the plugin hooks grant access to.
+    """
+    principal.invalidate()
+    user = factories.User(name=principal.DEFAULT_USER)
+    yield user
+    principal.invalidate()
+
+
+@pytest.fixture
+def clean_db(reset_db):
+    """Reset the database and create the extension tables with its
+    migrations, as ``ckan db upgrade -p cdp`` does.
+    """
+    from ckan.cli.db import _run_migrations
+    reset_db()
+    _run_migrations(u'cdp')
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for logic/action.py.
+"""
+import pytest
+
+from ckan import model
+from ckan.tests import factories, helpers
+import ckan.logic as logic
+
+
+@pytest.mark.usefixtures("clean_db", "cdp_user")
+def test_create_many_reports_missing_items():
+    user = factories.User()
+    datasets = [factories.Dataset() for _ in range(3)]
+
+    results = helpers.call_action(
+        'package_collaborator_create_many',
+        ids=[d['id'] for d in datasets] + ['missing'],
+        user_id=user['name'], capacity='editor')
+
+    assert [r['success'] for r in results] == [True, True, True, False]
+    assert results[3]['error'] == 'Dataset not found'
+    assert model.Session.query(model.PackageMember).filter_by(
+        user_id=user['id']).count() == 3
+
+    results = helpers.call_action(
+        'package_collaborator_create_many',
+        collaborators=[{'id': datasets[0]['name'], 'user_id': user['id'],
+                        'capacity': 'editor'}])
+    assert results[0]['result'] == 'noop'
+
+
+@pytest.mark.usefixtures("clean_db", "cdp_user")
+def test_delete_many():
+    user = factories.User()
+    datasets = [factories.Dataset() for _ in range(2)]
+    helpers.call_action(
+        'package_collaborator_create_many', ids=[datasets[0]['id']],
+        user_id=user['id'], capacity='member')
+
+    results = helpers.call_action(
+        'package_collaborator_delete_many',
+        ids=[d['id'] for d in datasets], user_id=user['id'])
+
+    assert results[0]['result'] == 'removed'
+    assert results[1]['success'] is False
+    assert model.Session.query(model.PackageMember).filter_by(
+        user_id=user['id']).count() == 0
+
+
+@pytest.mark.usefixtures("clean_db", "cdp_user")
+def test_batch_actions_require_sysadmin():
+    user = factories.User()
+    with pytest.raises(logic.NotAuthorized):
+        helpers.call_action(
+            'package_collaborator_create_many',
+            context={'user': user['name'], 'ignore_auth': False},
+            ids=[], user_id=user['id'], capacity='editor')
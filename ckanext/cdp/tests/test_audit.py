@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for audit.py and changes.py.
+"""
+import pytest
+
+from ckan import model
+from ckan.model import meta
+from ckan.tests import factories, helpers
+
+from ckanext.cdp import audit, model as cdp_model
+
+
+@pytest.fixture
+def audit_table(clean_db):
+    audit.flush()
+    yield
+    meta.engine.execute(cdp_model.cdp_audit_table.delete())
+
+
+@pytest.mark.usefixtures("audit_table")
+def test_consent_changes_are_audited(cdp_user):
+    sysadmin = factories.Sysadmin()
+    dataset = factories.Dataset()
+    helpers.call_action(
+        'package_patch', context={'user': sysadmin['name']},
+        id=dataset['id'], extras=[{'key': 'data_cdp', 'value': 'yes'}])
+    helpers.call_action(
+        'package_patch', context={'user': sysadmin['name']},
+        id=dataset['id'], notes='unrelated edit')
+
+    # nothing is written until the buffer is flushed
+    assert helpers.call_action(
+        'cdp_audit_list', package_id=dataset['id'])['results'] == []
+    assert audit.flush() == 1
+
+    history = helpers.call_action(
+        'cdp_audit_list', package_id=dataset['id'])['results']
+    assert len(history) == 1
+    assert history[0]['actor'] == sysadmin['name']
+    assert (history[0]['old_value'], history[0]['new_value']) == (None, 'yes')
+    assert history[0]['collaborator_user_id'] == cdp_user['id']
+    assert history[0]['result'] == 'added'
+
+
+@pytest.mark.usefixtures("audit_table", "cdp_user")
+def test_rolled_back_saves_are_not_audited():
+    dataset = factories.Dataset()
+    helpers.call_action(
+        'package_patch', context={'defer_commit': True},
+        id=dataset['id'], extras=[{'key': 'data_cdp', 'value': 'yes'}])
+    model.Session.rollback()
+
+    assert audit.flush() == 0
+    assert helpers.call_action(
+        'package_show', id=dataset['id']).get('data_cdp') != 'yes'
+
+
+@pytest.mark.usefixtures("audit_table")
+def test_audit_list_pages_newest_first():
+    for i in range(5):
+        audit.record('package-{}'.format(i), field='data_cdp')
+    model.repo.commit()
+    audit.flush()
+
+    first = helpers.call_action('cdp_audit_list', limit=3)
+    assert [r['package_id'] for r in first['results']] == [
+        'package-4', 'package-3', 'package-2']
+    second = helpers.call_action(
+        'cdp_audit_list', limit=3, before_id=first['next_before_id'])
+    assert [r['package_id'] for r in second['results']] == [
+        'package-1', 'package-0']
+    assert second['next_before_id'] is None
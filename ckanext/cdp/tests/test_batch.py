@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for batch.py.
+"""
+import pytest
+
+from ckan import model
+from ckan.tests import factories, helpers
+
+from ckanext.cdp.batch import CdpBatch, cdp_batch
+
+
+def _members(user_id):
+    return set(row.package_id for row in model.Session.query(
+        model.PackageMember).filter_by(user_id=user_id))
+
+
+@pytest.mark.usefixtures("clean_db")
+def test_batch_defers_until_exit(cdp_user):
+    with cdp_batch() as batch:
+        consented = [factories.Dataset(
+            extras=[{'key': 'data_cdp', 'value': 'yes'}]) for _ in range(3)]
+        factories.Dataset()
+        assert _members(cdp_user['id']) == set()
+        assert len(batch.package_ids) == 4
+
+    assert _members(cdp_user['id']) == set(d['id'] for d in consented)
+
+
+@pytest.mark.usefixtures("clean_db")
+def test_batch_from_context(cdp_user):
+    batch = CdpBatch()
+    dataset = helpers.call_action(
+        'package_create', context={'cdp_batch': batch}, name='batched',
+        extras=[{'key': 'data_cdp', 'value': 'yes'}])
+    assert _members(cdp_user['id']) == set()
+
+    assert batch.flush()['added'] == 1
+    assert _members(cdp_user['id']) == {dataset['id']}
+
+
+@pytest.mark.usefixtures("clean_db", "clean_index")
+def test_batch_datasets_are_indexed_without_a_reindex(cdp_user):
+    with cdp_batch():
+        consented = [factories.Dataset(
+            extras=[{'key': 'data_cdp', 'value': 'yes'}]) for _ in range(2)]
+        factories.Dataset()
+
+    indexed = helpers.call_action(
+        'package_search', fq='cdp_collaborator:true', rows=10)
+    assert sorted(d['id'] for d in indexed['results']) == sorted(
+        d['id'] for d in consented)
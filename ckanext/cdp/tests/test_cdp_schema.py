@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for cdp_schema.py.
+"""
+import json
+import os
+
+import pytest
+
+import ckan.plugins.toolkit as toolkit
+
+from ckanext.cdp import cdp_schema
+
+
+def test_merge_adds_data_cdp_once():
+    schema = cdp_schema.merge_custom_field({'dataset_fields': []})
+    schema = cdp_schema.merge_custom_field(schema)
+    assert [f['field_name'] for f in schema['dataset_fields']] == ['data_cdp']
+
+
+
+def test_merge_adds_bbox_validators():
+    schema = cdp_schema.merge_custom_field({'dataset_fields': [
+        {'field_name': 'west_bound_longitude'},
+        {'field_name': 'north_bound_longitude'},
+        {'field_name': 'title', 'validators': 'not_empty'},
+    ]})
+    validators = [f.get('validators') for f in schema['dataset_fields']]
+    assert validators[:3] == [
+        'ignore_missing cdp_bbox_longitude',
+        'ignore_missing cdp_bbox_latitude',
+        'not_empty',
+    ]
+
+def test_merged_schema_is_cached_by_hash(tmp_path, monkeypatch):
+    upstream = tmp_path / 'ckan_dataset.json'
+    upstream.write_text(json.dumps({'dataset_fields': []}))
+    monkeypatch.setattr(
+        cdp_schema, '_original_schema_path', lambda: str(upstream))
+
+    path = cdp_schema.merged_schema_path(str(tmp_path / 'cache'))
+    with open(path) as f:
+        assert json.load(f)['dataset_fields'][0]['field_name'] == 'data_cdp'
+
+    mtime = os.path.getmtime(path)
+    assert cdp_schema.merged_schema_path(str(tmp_path / 'cache')) == path
+    assert os.path.getmtime(path) == mtime
+
+    upstream.write_text(json.dumps({'dataset_fields': [
+        {'field_name': 'title'}]}))
+    assert cdp_schema.merged_schema_path(str(tmp_path / 'cache')) != path
+
+
+def test_merge_only_replaces_scheming_choice_validators():
+    schema = cdp_schema.merge_custom_field({'dataset_fields': [
+        {'field_name': 'license_id', 'validators': 'scheming_required',
+         'choices': [{'value': 'CC-BY'}]},
+        {'field_name': 'data_classification',
+         'choices': [{'value': 'public'}]},
+        {'field_name': 'data_language',
+         'validators': 'scheming_multiple_choice',
+         'choices': [{'value': 'th'}]},
+        {'field_name': 'data_language_other'},
+        {'field_name': 'unit', 'validators': 'ignore_missing scheming_choices',
+         'choices': [{'value': 'kg'}]},
+    ]})
+    validators = [f.get('validators') for f in schema['dataset_fields']]
+    assert validators[:5] == [
+        'scheming_required',
+        None,
+        'cdp_multiple_choice_data_language',
+        None,
+        'ignore_missing cdp_choice_unit',
+    ]
+
+
+def test_compiled_choice_validators(tmp_path):
+    path = tmp_path / 'schema.json'
+    path.write_text(json.dumps({'dataset_fields': [
+        {'field_name': 'data_cdp',
+         'validators': 'convert_to_extras ignore_missing',
+         'choices': [{'value': 'yes', 'label': 'Yes'},
+                     {'value': 'no', 'label': 'No'}]},
+        {'field_name': 'unit', 'validators': 'ignore_missing cdp_choice_unit',
+         'choices': [{'value': 'kg', 'label': 'Kilogram'}]},
+        {'field_name': 'data_language', 'required': True,
+         'validators': 'cdp_multiple_choice_data_language',
+         'choices': [{'value': 'th', 'label': 'Thai'},
+                     {'value': 'en', 'label': 'English'}]},
+    ]}))
+    validators = cdp_schema.choice_validators(str(path))
+
+    # only the validators the schema refers to are registered
+    assert sorted(validators) == [
+        'cdp_choice_unit', 'cdp_multiple_choice_data_language']
+
+    single = validators['cdp_choice_unit']
+    assert single('kg') == 'kg'
+    assert single('') == ''
+    with pytest.raises(toolkit.Invalid):
+        single('g')
+
+    multiple = validators['cdp_multiple_choice_data_language']
+    data = {('a',): ['en', 'th'], ('b',): 'en', ('c',): ['fr'], ('d',): []}
+    errors = dict((key, []) for key in data)
+    for key in data:
+        multiple(key, data, errors, {})
+    assert data[('a',)] == '["th", "en"]'
+    assert data[('b',)] == '["en"]'
+    assert errors[('c',)] == ['unexpected choice "fr"']
+    assert errors[('d',)] == ['Select at least one']
+    assert cdp_schema.compiled_choices(str(path))['data_cdp'].label('no') \
+        == 'No'
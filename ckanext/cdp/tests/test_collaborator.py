@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for collaborator.py.
+"""
+import pytest
+
+from ckan import model
+from ckan.tests import factories
+
+from ckanext.cdp import collaborator
+
+
+def _member(package_id, user_id):
+    return model.Session.query(model.PackageMember). \
+        filter(model.PackageMember.package_id == package_id). \
+        filter(model.PackageMember.user_id == user_id).one_or_none()
+
+
+@pytest.mark.usefixtures("clean_db", "cdp_user")
+def test_reconcile_adds_then_noop():
+    dataset = factories.Dataset()
+    user = factories.User()
+
+    assert collaborator.reconcile_collaborator(
+        {}, dataset['id'], user['id'], 'editor') == collaborator.ADDED
+    assert collaborator.reconcile_collaborator(
+        {}, dataset['id'], user['id'], 'editor') == collaborator.NOOP
+    assert _member(dataset['id'], user['id']).capacity == 'editor'
+
+
+@pytest.mark.usefixtures("clean_db", "cdp_user")
+def test_reconcile_updates_capacity_and_removes():
+    dataset = factories.Dataset()
+    user = factories.User()
+    collaborator.reconcile_collaborator(
+        {}, dataset['id'], user['id'], 'member')
+
+    assert collaborator.reconcile_collaborator(
+        {}, dataset['id'], user['id'], 'editor') == collaborator.UPDATED
+    assert collaborator.reconcile_collaborator(
+        {}, dataset['id'], user['id'], None) == collaborator.REMOVED
+    assert _member(dataset['id'], user['id']) is None
+    assert collaborator.reconcile_collaborator(
+        {}, dataset['id'], user['id'], None) == collaborator.NOOP
+
+
+@pytest.mark.usefixtures("clean_db", "cdp_user")
+def test_reconcile_range_backfills_from_extras():
+    user = factories.User()
+    wanted = factories.Dataset(extras=[{'key': 'data_cdp', 'value': 'yes'}])
+    stale = factories.Dataset()
+    collaborator.reconcile_collaborator({}, stale['id'], user['id'], 'editor')
+
+    chunks = list(collaborator.iter_package_chunks(1000))
+    assert len(chunks) == 1
+    lower, upper, size = chunks[0]
+
+    predicates = [('data_cdp', 'yes', 'editor')]
+    dry = collaborator.reconcile_range(
+        user['id'], predicates, lower, upper, dry_run=True)
+    assert dry == {'added': 1, 'updated': 0, 'removed': 1}
+    assert _member(wanted['id'], user['id']) is None
+
+    assert collaborator.reconcile_range(
+        user['id'], predicates, lower, upper) == dry
+    assert _member(wanted['id'], user['id']).capacity == 'editor'
+    assert _member(stale['id'], user['id']) is None
+
+
+@pytest.mark.usefixtures("clean_db", "cdp_user")
+def test_reconcile_package_changes_several_users_at_once():
+    dataset = factories.Dataset()
+    editor, member, removed = factories.User(), factories.User(), \
+        factories.User()
+    collaborator.reconcile_collaborator(
+        {}, dataset['id'], removed['id'], 'editor')
+
+    results = collaborator.reconcile_package({}, dataset['id'], {
+        editor['id']: 'editor',
+        member['id']: 'member',
+        removed['id']: None,
+    })
+
+    assert results == {
+        editor['id']: collaborator.ADDED,
+        member['id']: collaborator.ADDED,
+        removed['id']: collaborator.REMOVED,
+    }
+    assert collaborator.get_capacities(
+        dataset['id'], [editor['id'], member['id'], removed['id']]) == {
+            editor['id']: 'editor', member['id']: 'member'}
+
+
+@pytest.mark.usefixtures("clean_db", "cdp_user")
+def test_reconcile_range_uses_first_matching_predicate():
+    user = factories.User()
+    both = factories.Dataset(extras=[
+        {'key': 'data_cdp', 'value': 'yes'},
+        {'key': 'data_partner', 'value': 'yes'}])
+    partner = factories.Dataset(extras=[
+        {'key': 'data_partner', 'value': 'yes'}])
+    lower, upper, _ = next(collaborator.iter_package_chunks(1000))
+
+    collaborator.reconcile_range(user['id'], [
+        ('data_cdp', 'yes', 'editor'),
+        ('data_partner', 'yes', 'member'),
+    ], lower, upper)
+
+    assert _member(both['id'], user['id']).capacity == 'editor'
+    assert _member(partner['id'], user['id']).capacity == 'member'
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""
+Multi-process stress test for the collaborator upsert/delete statements.
+
+Several processes grant conflicting capacities on and revoke the same
+(package, user) pairs at the same time. With the old check-then-insert path
+this produced duplicate key errors; the single-statement upsert/delete must
+not raise, must leave at most one row per pair, and each pair must end in
+the state of the last write that committed for it (last writer wins).
+
+Every write carries its own ``modified`` value, so the row left behind can
+be matched to exactly one write. Each worker reports its last write per
+pair; since a worker's writes commit in order, the final state of a pair
+must be the last write of one of the workers.
+
+By default a SQLite file in a temporary directory is used. Point
+``CKANEXT_CDP_STRESS_DB`` at an empty PostgreSQL database to exercise
+``INSERT ... ON CONFLICT`` instead.
+"""
+import datetime
+import multiprocessing
+import os
+import random
+
+import pytest
+from sqlalchemy import (
+    Column, DateTime, MetaData, Table, UnicodeText, create_engine, func,
+    select,
+)
+
+from ckanext.cdp import collaborator
+from ckanext.cdp.model import cdp_revocation_table
+
+PROCESSES = 6
+ROUNDS = 150
+EPOCH = datetime.datetime(2020, 1, 1)
+PACKAGES = ['package-{}'.format(i) for i in range(5)]
+USERS = ['cdp_user', 'other_user']
+
+
+def _table(metadata):
+    return Table(
+        'package_member', metadata,
+        Column('package_id', UnicodeText, primary_key=True),
+        Column('user_id', UnicodeText, primary_key=True),
+        Column('capacity', UnicodeText, nullable=False),
+        Column('modified', DateTime, nullable=False),
+    )
+
+
+def _engine(url):
+    if url.startswith('sqlite'):
+        return create_engine(url, connect_args={'timeout': 60})
+    return create_engine(url)
+
+
+def _hammer(url, seed, errors, results):
+    rng = random.Random(seed)
+    engine = _engine(url)
+    last = {}
+    try:
+        for i in range(ROUNDS):
+            pair = (rng.choice(PACKAGES), rng.choice(USERS))
+            with engine.begin() as connection:
+                if rng.random() < 0.7:
+                    # modified ไม่ซ้ำกันในทุก process
+                    # จึงบอกได้ว่าแถวที่เหลือมาจากการเขียนครั้งไหน
+                    write = (rng.choice(['editor', 'member']),
+                             EPOCH + datetime.timedelta(
+                                 seconds=seed * ROUNDS + i))
+                    collaborator.upsert_members([{
+                        'package_id': pair[0], 'user_id': pair[1],
+                        'capacity': write[0], 'modified': write[1],
+                    }], connection)
+                else:
+                    write = None
+                    collaborator.delete_members([pair], connection)
+            last[pair] = write
+    except Exception as e:
+        errors.put(repr(e))
+    finally:
+        results.put(last)
+        engine.dispose()
+
+
+@pytest.fixture
+def database_url(tmp_path):
+    url = os.environ.get('CKANEXT_CDP_STRESS_DB') or \
+        'sqlite:///{}'.format(tmp_path / 'stress.db')
+    engine = _engine(url)
+    table = _table(MetaData())
+    for t in (table, cdp_revocation_table):
+        t.drop(engine, checkfirst=True)
+        t.create(engine)
+    engine.dispose()
+    yield url
+    engine = _engine(url)
+    for t in (table, cdp_revocation_table):
+        t.drop(engine, checkfirst=True)
+    engine.dispose()
+
+
+def test_concurrent_upserts_and_deletes(database_url):
+    errors = multiprocessing.Queue()
+    results = multiprocessing.Queue()
+    workers = [
+        multiprocessing.Process(
+            target=_hammer, args=(database_url, seed, errors, results))
+        for seed in range(PROCESSES)
+    ]
+    for worker in workers:
+        worker.start()
+    # อ่านผลก่อน join เพื่อไม่ให้ process ค้างตอนส่งข้อมูลผ่าน queue
+    last_writes = [results.get(timeout=120) for _ in workers]
+    for worker in workers:
+        worker.join(120)
+
+    failures = []
+    while not errors.empty():
+        failures.append(errors.get())
+    assert failures == []
+    assert [worker.exitcode for worker in workers] == [0] * PROCESSES
+
+    engine = _engine(database_url)
+    table = _table(MetaData())
+    rows = engine.execute(select([
+        table.c.package_id, table.c.user_id, table.c.capacity,
+        table.c.modified])).fetchall()
+    duplicates = engine.execute(
+        select([table.c.package_id, table.c.user_id])
+        .group_by(table.c.package_id, table.c.user_id)
+        .having(func.count() > 1)).fetchall()
+    engine.dispose()
+
+    assert duplicates == []
+    final = dict(((row[0], row[1]), (row[2], row[3])) for row in rows)
+    written = set()
+    for last in last_writes:
+        written.update(last)
+    assert set(final) <= written
+    for pair in written:
+        candidates = [last[pair] for last in last_writes if pair in last]
+        assert final.get(pair) in candidates, pair
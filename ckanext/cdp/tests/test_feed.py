@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for feed.py.
+"""
+import pytest
+
+from ckan.tests import factories, helpers
+
+from ckanext.cdp import collaborator, feed
+
+
+def test_cursor_round_trip():
+    import datetime
+    changed_at = datetime.datetime(2024, 5, 1, 10, 30, 0, 123)
+    cursor = feed.format_cursor(changed_at, 'abc')
+    assert feed.parse_cursor(cursor) == (changed_at, 'abc')
+    assert feed.parse_cursor('2024-05-01') == (
+        datetime.datetime(2024, 5, 1), None)
+    with pytest.raises(ValueError):
+        feed.parse_cursor('yesterday')
+
+
+@pytest.mark.usefixtures("clean_db")
+def test_feed_resumes_from_cursor(cdp_user):
+    first = factories.Dataset(extras=[{'key': 'data_cdp', 'value': 'yes'}])
+    second = factories.Dataset()
+
+    changes = list(feed.iter_changes(cdp_user['id']))
+    assert [c['id'] for c in changes] == [first['id'], second['id']]
+    assert changes[0]['cdp_capacity'] == 'editor'
+    assert changes[1]['cdp_capacity'] is None
+
+    cursor = changes[-1]['cursor']
+    assert list(feed.iter_changes(cdp_user['id'], cursor)) == []
+
+    helpers.call_action('package_patch', id=first['id'], notes='edited')
+    assert [c['id'] for c in feed.iter_changes(cdp_user['id'], cursor)] == [
+        first['id']]
+
+
+@pytest.mark.usefixtures("clean_db")
+def test_revocations_outside_the_hooks_are_in_the_feed(cdp_user):
+    dataset = factories.Dataset(extras=[{'key': 'data_cdp', 'value': 'yes'}])
+    cursor = list(feed.iter_changes(cdp_user['id']))[-1]['cursor']
+
+    # e.g. a batch flush or `ckan cdp reconcile`: only package_member changes
+    collaborator.reconcile_packages(
+        cdp_user['id'], [('data_cdp', 'no-longer-matches', 'editor')],
+        [dataset['id']])
+
+    changes = list(feed.iter_changes(cdp_user['id'], cursor))
+    assert [c['id'] for c in changes] == [dataset['id']]
+    assert changes[0]['cdp_capacity'] is None
+    assert list(feed.iter_changes(cdp_user['id'], changes[-1]['cursor'])) \
+        == []
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for jobs.py.
+"""
+import pytest
+
+from ckan import model
+from ckan.tests import factories
+
+from ckanext.cdp import collaborator, jobs
+
+
+class FakeJob(object):
+
+    def __init__(self, fn, args, job_id):
+        self.fn, self.args, self.id = fn, args, job_id
+        self.status = 'queued'
+
+    def get_status(self):
+        return self.status
+
+
+class FakeRedis(object):
+
+    def __init__(self):
+        self.values = {}
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def set(self, key, value, ex=None):
+        self.values[key] = value.encode('utf-8')
+
+
+class FakeQueue(object):
+    """Synchronous stand-in for the RQ queue.
+    """
+
+    def __init__(self):
+        self.jobs = {}
+        self.connection = FakeRedis()
+
+    def fetch_job(self, job_id):
+        return self.jobs.get(job_id)
+
+    def enqueue(self, fn, args, title=None, queue=None, rq_kwargs=None):
+        job = FakeJob(fn, args, rq_kwargs['job_id'])
+        self.jobs[job.id] = job
+        return job
+
+    def run_all(self):
+        for job in self.jobs.values():
+            if job.status == 'queued':
+                job.fn(*job.args)
+                job.status = 'finished'
+
+
+@pytest.fixture
+def fake_queue(monkeypatch):
+    queue = FakeQueue()
+    monkeypatch.setattr(jobs.jobs, 'get_queue', lambda name=None: queue)
+    monkeypatch.setattr(jobs.jobs, 'enqueue', queue.enqueue)
+    return queue
+
+
+@pytest.mark.usefixtures("clean_db", "cdp_user")
+@pytest.mark.ckan_config("ckanext.cdp.async", "true")
+def test_rapid_edits_coalesce_into_one_job(fake_queue, cdp_user):
+    dataset = factories.Dataset()
+    for _ in range(10):
+        jobs.enqueue_reconcile(dataset['id'])
+
+    assert len(fake_queue.jobs) == 1
+
+    model.Package.get(dataset['id']).extras['data_cdp'] = 'yes'
+    model.repo.commit()
+    fake_queue.run_all()
+
+    member = model.Session.query(model.PackageMember).filter_by(
+        package_id=dataset['id'], user_id=cdp_user['id']).one()
+    assert member.capacity == 'editor'
+
+
+@pytest.mark.usefixtures("clean_db", "cdp_user")
+def test_job_is_idempotent():
+    dataset = factories.Dataset()
+    jobs.reconcile_package_job(dataset['id'])
+    assert jobs.reconcile_package_job(dataset['id']) == collaborator.NOOP
+
+
+@pytest.mark.usefixtures("clean_db", "cdp_user")
+@pytest.mark.ckan_config("ckanext.cdp.async", "true")
+def test_jobs_are_queued_after_commit(fake_queue):
+    dataset = factories.Dataset()
+    key = jobs.job_id(dataset['id'])
+
+    jobs.enqueue_after_commit(dataset['id'])
+    model.Session.rollback()
+    assert fake_queue.jobs == {}
+
+    jobs.enqueue_after_commit(dataset['id'])
+    assert fake_queue.jobs == {}
+    model.repo.commit()
+    job, = fake_queue.jobs.values()
+    assert job.id.startswith(key)
+    assert job.args == [dataset['id']]
+
+
+@pytest.mark.usefixtures("clean_db", "cdp_user")
+@pytest.mark.ckan_config("ckanext.cdp.async", "true")
+def test_save_while_the_job_runs_queues_a_new_job(fake_queue):
+    dataset = factories.Dataset()
+    running = jobs.enqueue_reconcile(dataset['id'])
+    running.status = 'started'
+
+    queued = jobs.enqueue_reconcile(dataset['id'])
+
+    assert queued.id != running.id
+    assert fake_queue.jobs[running.id] is running
+    assert running.status == 'started'
+    assert queued.status == 'queued'
+    # saves made while the new job waits are coalesced into it
+    assert jobs.enqueue_reconcile(dataset['id']) is queued
+    assert len(fake_queue.jobs) == 2
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for metrics.py.
+"""
+import pytest
+
+from ckan import model
+
+from ckanext.cdp import metrics
+
+
+@pytest.fixture(autouse=True)
+def _reset():
+    metrics.reset()
+    yield
+    metrics.reset()
+
+
+def test_call_records_outcome_and_histogram():
+    assert metrics.call('op', lambda: 'added') == 'added'
+    metrics.call('op', lambda: {'result': 1})
+    with pytest.raises(ValueError):
+        metrics.call('op', lambda: int('x'))
+
+    text = metrics.prometheus_text()
+    assert 'ckanext_cdp_duration_seconds_count{operation="op"} 3' in text
+    assert 'ckanext_cdp_duration_seconds_bucket{operation="op",le="+Inf"} 3' \
+        in text
+    for outcome in ('added', 'ok', 'error'):
+        assert 'ckanext_cdp_operations_total{{operation="op",outcome="{}"}} 1' \
+            .format(outcome) in text
+
+
+@pytest.mark.usefixtures("clean_db")
+def test_queries_are_counted():
+    metrics.install()
+    metrics.call('query', lambda: model.Session.execute('SELECT 1'))
+    assert 'ckanext_cdp_queries_total{operation="query"} 1' in \
+        metrics.prometheus_text()
@@ -47,7 +47,92 @@ To temporary patch the CKAN configuration for the duration of a test you can use
     def test_some_action():
         pass
 """
+import pytest
+
+from ckan.tests import factories, helpers
+
 import ckanext.cdp.plugin as plugin
 
 def test_plugin():
     pass
+
+
+@pytest.mark.usefixtures("clean_db", "clean_index", "cdp_user")
+def test_consented_datasets_are_indexed_and_listed():
+    consented = [factories.Dataset(
+        extras=[{'key': 'data_cdp', 'value': 'yes'}]) for _ in range(3)]
+    factories.Dataset(extras=[{'key': 'data_cdp', 'value': 'no'}])
+
+    facets = helpers.call_action(
+        'package_search', fq='cdp_consent:yes', rows=0)
+    assert facets['count'] == 3
+
+    first = helpers.call_action('cdp_dataset_list', limit=2)
+    assert first['count'] == 3
+    assert first['next_cursor'] == first['results'][-1]['id']
+    second = helpers.call_action(
+        'cdp_dataset_list', limit=2, cursor=first['next_cursor'])
+    assert second['next_cursor'] is None
+
+    listed = [d['id'] for d in first['results'] + second['results']]
+    assert listed == sorted(d['id'] for d in consented)
+
+
+@pytest.mark.usefixtures("clean_db", "clean_index", "cdp_user")
+def test_dataset_list_last_full_page_and_string_fl():
+    consented = [factories.Dataset(
+        extras=[{'key': 'data_cdp', 'value': 'yes'}]) for _ in range(2)]
+
+    # fl as a GET request sends it
+    page = helpers.call_action('cdp_dataset_list', limit=2, fl='name,title')
+    assert page['next_cursor'] is None
+    assert [d['id'] for d in page['results']] == sorted(
+        d['id'] for d in consented)
+    assert set(page['results'][0]) == {'id', 'name', 'title'}
+
+
+@pytest.mark.usefixtures("clean_db", "cdp_user")
+def test_unrelated_edits_do_not_touch_collaborators(monkeypatch):
+    from ckanext.cdp import collaborator
+
+    dataset = factories.Dataset(extras=[{'key': 'data_cdp', 'value': 'yes'}])
+
+    def fail(*args, **kwargs):
+        raise AssertionError('collaborators should not be reconciled')
+    monkeypatch.setattr(collaborator, 'reconcile_package', fail)
+
+    helpers.call_action('package_patch', id=dataset['id'], notes='edited')
+
+
+@pytest.mark.usefixtures("clean_db", "cdp_user")
+def test_consent_change_is_dispatched(cdp_user):
+    from ckan import model
+
+    dataset = factories.Dataset()
+    helpers.call_action(
+        'package_patch', id=dataset['id'],
+        extras=[{'key': 'data_cdp', 'value': 'yes'}])
+    assert model.Session.query(model.PackageMember).filter_by(
+        package_id=dataset['id'], user_id=cdp_user['id']).count() == 1
+
+    helpers.call_action(
+        'package_patch', id=dataset['id'],
+        extras=[{'key': 'data_cdp', 'value': 'no'}])
+    assert model.Session.query(model.PackageMember).filter_by(
+        package_id=dataset['id'], user_id=cdp_user['id']).count() == 0
+
+
+@pytest.mark.usefixtures("clean_db", "clean_index", "cdp_user")
+def test_indexing_runs_no_queries():
+    from ckanext.cdp import metrics
+
+    metrics.install()
+    metrics.reset()
+    dataset = factories.Dataset(extras=[{'key': 'data_cdp', 'value': 'yes'}])
+    helpers.call_action('package_patch', id=dataset['id'], notes='edited')
+
+    indexed = metrics.snapshot('before_index')
+    assert indexed['count'] >= 2
+    assert indexed['queries'] == 0
+    assert helpers.call_action(
+        'package_search', fq='cdp_collaborator:true')['count'] == 1
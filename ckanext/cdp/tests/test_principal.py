@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for principal.py.
+"""
+import pytest
+
+from ckan import model
+from ckan.logic import NotFound
+from ckan.tests import factories
+
+from ckanext.cdp import principal
+
+
+@pytest.fixture(autouse=True)
+def _clear_cache():
+    principal.invalidate()
+    yield
+    principal.invalidate()
+
+
+@pytest.mark.usefixtures("clean_db")
+def test_missing_user_fails_fast():
+    with pytest.raises(NotFound) as exc:
+        principal.get_user_id()
+    assert 'cdp_user' in str(exc.value)
+
+
+@pytest.mark.usefixtures("clean_db")
+@pytest.mark.ckan_config("ckanext.cdp.user", "other_cdp")
+def test_user_name_from_config():
+    user = factories.User(name="other_cdp")
+    assert principal.get_user_id() == user['id']
+
+
+@pytest.mark.usefixtures("clean_db")
+def test_cache_invalidated_on_rename():
+    user = factories.User(name="cdp_user")
+    assert principal.get_user_id() == user['id']
+
+    obj = model.User.get(user['id'])
+    obj.name = "renamed_cdp_user"
+    model.repo.commit()
+
+    with pytest.raises(NotFound):
+        principal.get_user_id()
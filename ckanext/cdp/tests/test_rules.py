@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for rules.py.
+"""
+import json
+
+import pytest
+
+from ckan import model
+from ckan.plugins import toolkit
+from ckan.tests import factories, helpers
+
+from ckanext.cdp import principal, rules
+
+PARTNER_RULES = [
+    {'field': 'data_cdp', 'value': 'yes',
+     'user': principal.DEFAULT_USER, 'capacity': 'editor'},
+    {'field': 'data_cdp', 'value': 'yes',
+     'user': 'partner_user', 'capacity': 'member'},
+]
+
+
+@pytest.fixture
+def partner_rules():
+    rules.configure({'ckanext.cdp.rules': json.dumps(PARTNER_RULES)})
+    yield
+    rules.configure(toolkit.config)
+
+
+def test_default_rule_grants_cdp_user_editor():
+    ruleset = rules.compile_rules(rules.load_entries({}))
+
+    assert ruleset.users == (principal.DEFAULT_USER,)
+    assert ruleset.desired({'data_cdp': 'yes'}.get) == {
+        principal.DEFAULT_USER: 'editor'}
+    assert ruleset.desired({'data_cdp': 'no'}.get) == {
+        principal.DEFAULT_USER: None}
+
+
+def test_first_matching_rule_wins():
+    ruleset = rules.compile_rules([
+        {'field': 'data_cdp', 'value': 'yes',
+         'user': 'cdp_user', 'capacity': 'editor'},
+        {'field': 'data_health', 'value': 'yes',
+         'user': 'cdp_user', 'capacity': 'member'},
+        {'field': 'data_health', 'value': 'yes',
+         'user': 'moph_user', 'capacity': 'editor'},
+    ])
+
+    assert ruleset.fields == ('data_cdp', 'data_health')
+    assert ruleset.desired({'data_health': 'yes'}.get) == {
+        'cdp_user': 'member', 'moph_user': 'editor'}
+    assert ruleset.desired(
+        {'data_cdp': 'yes', 'data_health': 'yes'}.get)['cdp_user'] == 'editor'
+
+
+@pytest.mark.parametrize('entries', [
+    [],
+    [{'field': 'data_cdp', 'value': 'yes', 'user': 'cdp_user'}],
+    [{'field': 'data_cdp', 'value': 'yes', 'user': 'cdp_user',
+      'capacity': 'admin'}],
+])
+def test_invalid_rules_are_rejected(entries):
+    with pytest.raises(ValueError):
+        rules.compile_rules(entries)
+
+
+@pytest.mark.usefixtures("clean_db", "cdp_user", "partner_rules")
+def test_all_rule_users_are_reconciled_on_save(cdp_user):
+    partner = factories.User(name='partner_user')
+    dataset = helpers.call_action(
+        'package_create', name='shared',
+        extras=[{'key': 'data_cdp', 'value': 'yes'}])
+
+    members = dict(model.Session.query(
+        model.PackageMember.user_id, model.PackageMember.capacity).filter_by(
+            package_id=dataset['id']))
+    assert members == {cdp_user['id']: 'editor', partner['id']: 'member'}
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for spatial.py and the bounding box validators.
+"""
+import random
+
+import pytest
+
+from ckan import model
+from ckan.plugins import toolkit
+from ckan.tests import factories, helpers
+
+from ckanext.cdp import spatial, validators
+
+
+def _bbox_extras(west, south, east, north):
+    return [{'key': key, 'value': str(value)} for key, value in zip(
+        spatial.BBOX_FIELDS, (west, south, east, north))]
+
+
+def _random_box(rnd):
+    x, y = rnd.uniform(-180, 170), rnd.uniform(-90, 80)
+    return (x, y, x + rnd.uniform(0, 10), y + rnd.uniform(0, 10))
+
+
+@pytest.fixture
+def bbox_index():
+    spatial.reset()
+    yield
+    spatial.reset()
+
+
+@pytest.mark.parametrize('value, expected', [
+    ('100.5', '100.5'),
+    ('13.75 S', '-13.75'),
+    (u'100°30\'15"E', '100.504167'),
+    ('100,25', '100.25'),
+])
+def test_coordinates_are_normalised(value, expected):
+    assert validators.cdp_bbox_longitude(value) == expected
+
+
+def test_out_of_range_coordinates_are_rejected():
+    with pytest.raises(toolkit.Invalid):
+        validators.cdp_bbox_latitude('95')
+    with pytest.raises(toolkit.Invalid):
+        validators.cdp_bbox_longitude('east')
+
+
+def test_index_matches_a_full_scan_after_updates():
+    rnd = random.Random(7)
+    records = dict((str(i), (_random_box(rnd), False)) for i in range(2000))
+    index = spatial.BBoxIndex(records)
+    for _ in range(300):
+        key = str(rnd.randrange(2500))
+        if rnd.random() < 0.2:
+            index.remove(key)
+            records.pop(key, None)
+        else:
+            box = _random_box(rnd)
+            index.update(key, box)
+            records[key] = (box, False)
+
+    for relation in spatial.RELATIONS:
+        for _ in range(20):
+            query = _random_box(rnd)
+            expected = sorted(
+                key for key, (box, _) in records.items()
+                if spatial._MATCH[relation](box, query))
+            assert [key for key, _ in index.search(query, relation)] == \
+                expected
+
+
+@pytest.mark.usefixtures("clean_db", "cdp_user", "bbox_index")
+def test_bbox_search_action():
+    bangkok = factories.Dataset(extras=_bbox_extras(100.3, 13.5, 100.9, 14.0))
+    factories.Dataset(extras=_bbox_extras(98.2, 18.6, 99.3, 19.2))
+
+    result = helpers.call_action(
+        'cdp_bbox_search', bbox='100.5,13.7,100.5,13.7', relation='contains')
+    assert [d['id'] for d in result['results']] == [bangkok['id']]
+
+    # the index is updated by the package hooks once it has been built
+    helpers.call_action(
+        'package_patch', id=bangkok['id'],
+        extras=_bbox_extras(101.0, 12.5, 101.5, 13.0))
+    assert helpers.call_action(
+        'cdp_bbox_search', bbox='100,13.5,100.9,15')['count'] == 0
+
+
+@pytest.mark.usefixtures("clean_db", "cdp_user", "bbox_index")
+def test_rolled_back_saves_do_not_change_the_index():
+    dataset = factories.Dataset(extras=_bbox_extras(100.3, 13.5, 100.9, 14.0))
+    assert helpers.call_action(
+        'cdp_bbox_search', bbox='100,13.5,100.9,15')['count'] == 1
+
+    helpers.call_action(
+        'package_patch', context={'defer_commit': True}, id=dataset['id'],
+        extras=_bbox_extras(101.0, 12.5, 101.5, 13.0))
+    model.Session.rollback()
+
+    assert helpers.call_action(
+        'cdp_bbox_search', bbox='100,13.5,100.9,15')['count'] == 1
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""
+งานที่ต้องทำหลัง transaction ของ model.Session commit แล้วเท่านั้น
+
+hook ของ plugin (after_create/after_update) ทำงานก่อนที่ action จะ commit
+งานที่ต้องเห็นข้อมูลที่ commit แล้ว (เช่น background job) หรือไม่ควรเกิดขึ้นเมื่อ
+การบันทึก rollback (เช่น audit) จึงถูกพักไว้ด้วย stage() ใน ``Session.info``
+แล้วส่งให้ callback ที่ลงทะเบียนด้วย register() ตอน ``after_commit``
+ถ้า transaction rollback รายการที่พักไว้จะถูกทิ้ง
+"""
+import logging
+
+from sqlalchemy import event
+
+from ckan import model
+
+log = logging.getLogger(__name__)
+
+INFO_KEY = 'cdp_after_commit'
+
+# ชื่อ -> callback(list ของรายการที่พักไว้)
+_callbacks = {}
+_listening = False
+
+
+def register(name, callback):
+    """
+    ลงทะเบียน callback(items) ที่ถูกเรียกหลัง commit ด้วยรายการของ ``name``
+    ที่พักไว้ใน transaction นั้น (ตามลำดับที่ stage)
+    """
+    _callbacks[name] = callback
+    _listen()
+
+
+def _listen():
+    global _listening
+    if _listening:
+        return
+    event.listen(model.Session, 'after_commit', _after_commit)
+    event.listen(model.Session, 'after_rollback', _after_rollback)
+    _listening = True
+
+
+def stage(name, item):
+    """
+    พักรายการไว้จนกว่า transaction ปัจจุบันของ model.Session จะ commit
+    """
+    pending = model.Session().info.setdefault(INFO_KEY, {})
+    pending.setdefault(name, []).append(item)
+
+
+def pending(name):
+    """
+    รายการของ ``name`` ที่ยังรอ commit อยู่ใน transaction ปัจจุบัน
+    """
+    return list(model.Session().info.get(INFO_KEY, {}).get(name, ()))
+
+
+def _after_commit(session):
+    pending = session.info.pop(INFO_KEY, None)
+    if not pending:
+        return
+    for name, items in pending.items():
+        callback = _callbacks.get(name)
+        if callback is None:
+            continue
+        # ข้อมูลถูก commit ไปแล้ว error ของ callback ไม่ควรทำให้ action ล้ม
+        try:
+            callback(items)
+        except Exception:
+            log.exception('CDP after-commit callback %s failed', name)
+
+
+def _after_rollback(session):
+    session.info.pop(INFO_KEY, None)
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+Validator ของ CDP ที่ลงทะเบียนผ่าน IValidators และอ้างถึงจาก schema ที่ merge แล้ว
+(ดู cdp_schema.merge_custom_field) validator ของฟิลด์แบบ choice ถูกสร้างจาก
+schema ใน cdp_schema.choice_validators
+"""
+import re
+
+import ckan.plugins.toolkit as toolkit
+
+from ckanext.cdp import cdp_schema
+
+# 100.5, -13.75, 100.5E, 13.75 N, 100.5°
+_DECIMAL_RE = re.compile(
+    r'^([+-]?\d+(?:\.\d*)?)\s*°?\s*([NSEW])?$', re.IGNORECASE)
+# 100°30'15"E, 13° 45.5' N
+_DMS_RE = re.compile(
+    r'^(\d+)\s*[°d]\s*'
+    r'(?:(\d+(?:\.\d*)?)\s*[\'′m]\s*)?'
+    r'(?:(\d+(?:\.\d*)?)\s*(?:"|″|\'\'|s)\s*)?'
+    r'([NSEW])?$', re.IGNORECASE)
+
+
+def get_validators():
+    validators = {
+        'cdp_bbox_longitude': cdp_bbox_longitude,
+        'cdp_bbox_latitude': cdp_bbox_latitude,
+    }
+    validators.update(cdp_schema.choice_validators())
+    return validators
+
+
+def parse_coordinate(value):
+    """
+    แปลงค่าพิกัดที่กรอกเป็นข้อความ (ทศนิยม หรือ องศา/ลิปดา/ฟิลิปดา พร้อมทิศ)
+    เป็น float หรือ raise ValueError
+    """
+    text = value.strip().replace(',', '.') if '.' not in value \
+        else value.strip()
+    match = _DECIMAL_RE.match(text)
+    if match:
+        number, hemisphere = float(match.group(1)), match.group(2)
+    else:
+        match = _DMS_RE.match(text)
+        if not match:
+            raise ValueError(value)
+        degrees, minutes, seconds, hemisphere = match.groups()
+        number = float(degrees) + float(minutes or 0) / 60 + \
+            float(seconds or 0) / 3600
+    if hemisphere and hemisphere.upper() in 'SW':
+        number = -abs(number)
+    return number
+
+
+def format_coordinate(number):
+    """
+    ค่าพิกัดเป็นข้อความแบบทศนิยม 6 ตำแหน่ง (ประมาณ 0.1 เมตร) โดยตัดศูนย์ท้าย
+    """
+    text = '{:.6f}'.format(number).rstrip('0').rstrip('.')
+    return '0' if text == '-0' else text
+
+
+def _coordinate_validator(limit, name, function_name):
+    def validator(value):
+        if value is None or value == '' or value is toolkit.missing:
+            return value
+        try:
+            number = parse_coordinate(str(value))
+        except ValueError:
+            raise toolkit.Invalid(
+                'Enter the {} as a decimal number of degrees'.format(name))
+        if not -limit <= number <= limit:
+            raise toolkit.Invalid(
+                'The {} must be between -{} and {}'.format(
+                    name, limit, limit))
+        return format_coordinate(number)
+    validator.__name__ = function_name
+    return validator
+
+
+cdp_bbox_longitude = _coordinate_validator(
+    180, 'longitude', 'cdp_bbox_longitude')
+cdp_bbox_latitude = _coordinate_validator(90, 'latitude', 'cdp_bbox_latitude')
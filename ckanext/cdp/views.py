@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+import hmac
+import logging
+
+from flask import Blueprint, Response, stream_with_context
+
+import ckan.plugins.toolkit as toolkit
+
+from ckanext.cdp import audit, feed, metrics, principal
+
+log = logging.getLogger(__name__)
+
+cdp = Blueprint(u'cdp', __name__)
+
+
+def changes():
+    u'''Stream the CDP change feed as JSON Lines.
+    '''
+    try:
+        toolkit.check_access(u'cdp_change_feed', {u'user': toolkit.c.user})
+    except toolkit.NotAuthorized:
+        return toolkit.abort(403, toolkit._(u'Not authorized to see this page'))
+
+    cursor = toolkit.request.args.get(u'cursor')
+    try:
+        feed.parse_cursor(cursor)
+    except ValueError:
+        return toolkit.abort(400, toolkit._(u'Invalid cursor'))
+
+    user_id = principal.get_user_id()
+    return Response(
+        stream_with_context(feed.iter_json_lines(user_id, cursor)),
+        mimetype=u'application/x-ndjson')
+
+
+def metrics_view():
+    u'''Per-process CDP metrics in Prometheus text format.
+
+    Readable by sysadmins, or with ``Authorization: Bearer <token>`` when
+    ``ckanext.cdp.metrics_token`` is set.
+    '''
+    token = toolkit.config.get(u'ckanext.cdp.metrics_token')
+    header = toolkit.request.headers.get(u'Authorization', u'')
+    # เทียบแบบ constant-time เพื่อไม่ให้เดา token จากเวลาที่ใช้ตอบ
+    allowed = bool(token) and hmac.compare_digest(
+        header.encode('utf-8'), (u'Bearer ' + token).encode('utf-8'))
+    if not allowed:
+        allowed = bool(toolkit.c.userobj and toolkit.c.userobj.sysadmin)
+    if not allowed:
+        return toolkit.abort(403, toolkit._(u'Not authorized to see this page'))
+    return Response(
+        metrics.prometheus_text(),
+        mimetype=u'text/plain; version=0.0.4; charset=utf-8')
+
+
+def flush_audit(exception=None):
+    u'''Write buffered audit records once they are due, also on servers
+    that do not run the background flush thread.
+    '''
+    try:
+        audit.flush_if_due()
+    except Exception:
+        log.exception(u'Could not write CDP audit records')
+
+
+cdp.add_url_rule(u'/api/cdp/changes', view_func=changes)
+cdp.add_url_rule(u'/cdp/metrics', view_func=metrics_view)
+cdp.teardown_app_request(flush_audit)
+
+
+def get_blueprints():
+    return [cdp]
@@ -4,10 +4,6 @@ from setuptools import setup, find_packages
 from codecs import open  # To use a consistent encoding
 from os import path
 
-# Import และเรียกใช้ฟังก์ชันเพื่อสร้างไฟล์ schema ตอน setup
-from ckanext.cdp.cdp_schema import save_merged_schema
-save_merged_schema()
-
 here = path.abspath(path.dirname(__file__))
 
 # Get the long description from the relevant file
@@ -49,7 +45,7 @@ setup(
 
         # Specify the Python versions you support here. In particular, ensure
         # that you indicate whether you support Python 2, Python 3 or both.
-        'Programming Language :: Python :: 2.7',
+        'Programming Language :: Python :: 3',
     ],
 
 